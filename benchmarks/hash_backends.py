@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Compare the file hashing backends in odea.
+
+The baseline is the original ``_get_hash`` loop, which allocates a new bytes
+object for every ``read()``; it is reproduced here so the comparison remains
+possible after the library code has changed. The other backends are the
+reused-buffer ``readinto`` path and the ``mmap`` path used by
+``odea._read_hashes``.
+
+Usage::
+
+    python benchmarks/hash_backends.py --size 4 --block-size 1024
+
+For cold-cache figures, run as root with ``--drop-caches`` (Linux only), or
+point ``--file`` at an existing multi-GB file on the device to be measured.
+"""
+
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import odea
+
+
+def baseline(filename, alg, block_size):
+    """The original ``odea._get_hash`` implementation."""
+    m = hashlib.new(alg)
+    with open(filename, 'rb') as fh:
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            m.update(block)
+    return m.hexdigest()
+
+
+def readinto(filename, alg, block_size):
+    m = hashlib.new(alg)
+    with open(filename, 'rb', buffering=0) as fh:
+        odea._hash_readinto(fh, [m], block_size)
+    return m.hexdigest()
+
+
+def mmapped(filename, alg, block_size):
+    m = hashlib.new(alg)
+    with open(filename, 'rb', buffering=0) as fh:
+        odea._hash_mmap(fh, [m], block_size)
+    return m.hexdigest()
+
+
+BACKENDS = [('read (baseline)', baseline), ('readinto', readinto),
+            ('mmap', mmapped)]
+
+
+def make_file(size_gib):
+    fd, filename = tempfile.mkstemp(prefix='odea_bench_')
+    chunk = os.urandom(64 * 1024 * 1024)
+    remaining = int(size_gib * 1024 ** 3)
+    with os.fdopen(fd, 'wb') as out:
+        while remaining > 0:
+            out.write(chunk[:remaining])
+            remaining -= len(chunk)
+    return filename
+
+
+def drop_caches():
+    subprocess.run(['sync'])
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--file', help='existing file to hash')
+    parser.add_argument('--size', type=float, default=2,
+                        help='size of the generated test file, in GiB')
+    parser.add_argument('--block-size', type=int, default=512,
+                        help='block size in KiB')
+    parser.add_argument('--alg', default='sha512')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--drop-caches', action='store_true',
+                        help='drop the page cache before each run')
+    args = parser.parse_args()
+
+    filename = args.file or make_file(args.size)
+    size = os.path.getsize(filename)
+    block_size = args.block_size * 1024
+    print('{}: {} bytes, block size {} KiB, {}'.format(
+            filename, size, args.block_size, args.alg))
+
+    try:
+        digests = set()
+        for name, fn in BACKENDS:
+            best = None
+            for _ in range(args.repeat):
+                if args.drop_caches:
+                    drop_caches()
+                start = time.perf_counter()
+                digests.add(fn(filename, args.alg, block_size))
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print('{:<16} {:8.3f} s {:10.1f} MiB/s'.format(
+                    name, best, size / best / 1024 ** 2))
+        if len(digests) != 1:
+            sys.exit('Backends disagree: {}'.format(digests))
+    finally:
+        if not args.file:
+            os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Measure the memory used by odea File and Item objects, and the throughput
+of their json serialization.
+
+The baseline is a plain dict-backed object carrying the same attributes, as
+File and Item were before they used ``__slots__``; if the ``jsons`` package
+is installed, ``jsons.dumps`` (the former serializer) is timed as well.
+
+Usage::
+
+    python benchmarks/objects.py --count 50000
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import odea
+
+IDENTIFIER = '48342ee3-9080-407e-9862-{:012d}'
+
+
+class Plain:
+    """A dict-backed object, for comparison."""
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+
+def file_tags(n):
+    identifier = IDENTIFIER.format(n)
+    return dict(
+        filename='data/interviews/tape_{}.SRC.{}.mov'.format(n, identifier),
+        basename='data/interviews/tape_{}'.format(n), format='SRC',
+        ext='mov', identifier=identifier, size=str(1024 * n),
+        mtime='2020-01-01T00:00:00Z', sha256='{:064x}'.format(n),
+        sha512='{:0128x}'.format(n), thumb=None, preview=None,
+        dimensions='1920x1080', duration='3600.0',
+        original_name='Tape {}.MOV'.format(n))
+
+
+def item_tags(n):
+    return dict(identifier=IDENTIFIER.format(n), title='Interview {}'.format(n),
+        creator=['A. Person'], subject=['spam', 'eggs'], contributor=None,
+        coverage=None, date='2020-01-01', description='An interview.',
+        language='en', publisher=None, relation=None, rights=None,
+        source=None, dcmi_type='MovingImage', note=None)
+
+
+def build(kind, count):
+    tags = file_tags if kind.endswith('File') else item_tags
+    if kind.startswith('Plain'):
+        return [Plain(**tags(n)) for n in range(count)]
+    # as in odea.load_file() and odea.load_item()
+    cls = odea.File if kind == 'File' else odea.Item
+    objects = []
+    for n in range(count):
+        o = cls()
+        for k, v in tags(n).items():
+            setattr(o, k, v)
+        objects.append(o)
+    return objects
+
+
+def measure(kind, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = build(kind, count)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return objects, used
+
+
+def throughput(objects, dumps):
+    start = time.perf_counter()
+    for o in objects:
+        dumps(o)
+    return len(objects) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+
+    # the memory figures include the tag values themselves, which are the
+    # same for every representation
+    for kind in ('Plain File', 'File', 'Plain Item', 'Item'):
+        objects, used = measure(kind, args.count)
+        print('{:<12} {:8.0f} bytes/object'.format(kind, used / args.count))
+        if not kind.startswith('Plain'):
+            print('{:<12} {:8.0f} json()/s'.format(
+                    '', throughput(objects, lambda o: o.json())))
+            try:
+                import jsons
+            except ImportError:
+                continue
+            print('{:<12} {:8.0f} jsons.dumps()/s'.format('', throughput(
+                    objects, lambda o: jsons.dumps(o, strip_privates=True))))
+
+
+if __name__ == '__main__':
+    main()
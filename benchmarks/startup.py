@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Measure the import time of odea and the command-line tool.
+
+Every drop target (e.g. ``static/odea_update.sh``) starts a new ``odea``
+process for each file, so the time taken to import the library is paid
+over and over. This runs ``python -X importtime`` in a fresh interpreter,
+reports the total and the slowest imports, and fails if any of the modules
+that odea imports on demand has been pulled back into startup.
+
+Usage::
+
+    python benchmarks/startup.py --repeat 5 --max-ms 150
+
+The first run after editing the source includes byte-compilation; the best
+of several runs is reported.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#: Modules that must not be imported by ``import odea`` (or ``import cli``).
+DEFERRED = ['bs4', 'PIL', 'jsons', 'slugify', 'pkg_resources', 'dbm',
+            'mimetypes', 'sqlite3', 'concurrent.futures', 'dataclasses']
+
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def importtime(module):
+    """Import <module> in a new interpreter. Return a list of (self_us,
+    cumulative_us, depth, name) tuples, one per imported module."""
+
+    r = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import {}'.format(module)],
+            cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True,
+            check=True)
+    rows = []
+    for line in r.stderr.splitlines():
+        m = LINE.match(line)
+        if m:
+            rows.append((int(m.group(1)), int(m.group(2)),
+                         len(m.group(3)) // 2, m.group(4)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--module', default='cli',
+                        help='module to import (default: cli, which '
+                        'imports odea)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest imports to list')
+    parser.add_argument('--max-ms', type=float,
+                        help='fail if the import takes longer than this')
+    args = parser.parse_args()
+
+    best = None
+    for _ in range(args.repeat):
+        rows = importtime(args.module)
+        total = sum(row[0] for row in rows)
+        if best is None or total < best[0]:
+            best = (total, rows)
+    total, rows = best
+
+    print('import {}: {:.1f} ms ({} modules)'.format(
+            args.module, total / 1000, len(rows)))
+    for self_us, cumulative_us, depth, name in sorted(
+                rows, key=lambda row: row[1], reverse=True)[:args.top]:
+        print('  {:8.1f} ms  {}'.format(cumulative_us / 1000, name))
+
+    problems = []
+    imported = set(row[3] for row in rows)
+    for name in DEFERRED:
+        if name in imported:
+            problems.append('{} is imported at startup'.format(name))
+    if args.max_ms is not None and total / 1000 > args.max_ms:
+        problems.append('import took {:.1f} ms (limit {} ms)'.format(
+                        total / 1000, args.max_ms))
+    if problems:
+        sys.exit('\n'.join(problems))
+
+
+if __name__ == '__main__':
+    main()
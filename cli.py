@@ -12,6 +12,8 @@ import argparse
 import pathlib
 import re
 import subprocess
+import time
+import collections
 
 import odea
 
@@ -36,8 +38,15 @@ def check_file(fn):
 
     sys.exit('Specify a valid input filename.')
 
-def update_file(fn):
-    """Update a filename, hash, metadata, and thumb for a file."""
+def update_file(fn, on_duplicate=None):
+    """Update a filename, hash, metadata, and thumb for a file.
+
+    If <on_duplicate> is given and the file is a source file with the same
+    contents as an existing source file in the bag, it is not tagged: with
+    "refuse" the program exits; with "link" the file is moved out of the
+    payload and recorded as a duplicate of the existing source, which is
+    returned instead, and "remove" does the same but deletes the file.
+    """
     filetype = check_file(fn)
 
     f = odea.load_file(fn)
@@ -53,13 +62,19 @@ def update_file(fn):
             f.original_name = f.filename
             f.basename = slug
 
+    # Hash before renaming, so duplicates are caught before anything changes
+    f.get_checksums()
+    if f.format == 'SRC' and on_duplicate:
+        dup = f.find_duplicate()
+        if dup is not None:
+            return duplicate(f, dup, on_duplicate)
+
     # TODO: Files within directories (capture parent UUID)
     if filetype == 'subfile':
         f.identifier = None
     # NOT YET IMPLEMENTED: Tag directories
     if filetype == 'file':
         f.rename()
-    f.get_sha256()
     f.get_mtime()
     f.get_size()
     # We may want to generate a thumb manually from a derivative
@@ -69,10 +84,31 @@ def update_file(fn):
     f.save()
     return f
 
-def update(fn):
+def duplicate(f, dup, action):
+    """Handle a file whose contents duplicate the existing source <dup>."""
+
+    existing = odea.load_file(dup)
+    if action == 'refuse':
+        sys.exit("{} duplicates {} (item {}); not imported".format(
+                    f.filename, dup, existing.identifier))
+    # link or remove: the copy is recorded against the existing source, and
+    # taken out of the payload rather than left there as an untagged file
+    try:
+        moved_to = existing.add_duplicate(f.filename,
+                                          remove=(action == 'remove'))
+    except OSError as e:
+        sys.exit("Could not {} {} (duplicates {}): {}".format(
+                    'remove' if action == 'remove' else 'move', f.filename,
+                    dup, e))
+    print("{} duplicates {}; {} and linked to item {}".format(
+            f.filename, dup, 'moved to {}'.format(moved_to) if moved_to
+            else 'removed', existing.identifier))
+    return existing
+
+def update(fn, on_duplicate=None):
     """Update a file and the parent item metadata."""
 
-    f = update_file(fn)
+    f = update_file(fn, on_duplicate)
     i = odea.load_item(f.identifier)
 
     if not i.title:
@@ -91,52 +127,104 @@ def edit(fn):
     subprocess.run(['editor', i.tag_file()])
 
 
-def derive(fn):
-    """Generate derivatives for a file."""
-    check_file(fn)
-    f = odea.load_file(fn)
-    o = list()
+def derive_targets(f):
+    """Return a list of (target, ext) derivatives to be generated for a
+    file."""
+    targets = []
     ext = f.ext.lower()
 
     ## html, plain text
     if ext in ('html', 'htm', 'txt', 'rst'):
-        update_file(f.derive('df-img-screenshot', 'png'))
-        # update_file(f.derive('df-pdf-wkhtml', 'pdf'))
+        targets.append(('df-img-screenshot', 'png'))
+        # targets.append(('df-pdf-wkhtml', 'pdf'))
 
     ## Markdown (we can also do this for plain text)
     if ext in ('md'):
-        update_file(f.derive('df-pandoc-html', 'html'))
+        targets.append(('df-pandoc-html', 'html'))
 
     ## reStructuredText
     if ext in ('rst'):
-        update_file(f.derive('df-docutils-html', 'html'))
+        targets.append(('df-docutils-html', 'html'))
 
     ## raster image
     if ext in ('bmp', 'gif', 'jpg', 'jpeg', 'png', 'tif', 'tiff'):
-        update_file(f.derive('df-img-med', 'png'))
-        update_file(f.derive('df-img-lg', 'png'))
+        targets.append(('df-img-med', 'png'))
+        targets.append(('df-img-lg', 'png'))
 
     ## audio file
     if ext in ('mp3', 'wav', 'wma', 'ogg'):
-        update_file(f.derive('pf-wav', 'wav'))
-        update_file(f.derive('df-mp3', 'mp3'))
+        targets.append(('pf-wav', 'wav'))
+        targets.append(('df-mp3', 'mp3'))
 
     ## office document
     if ext in ('odt', 'odp', 'doc', 'docx', 'ppt', 'pptx'):
-        update_file(f.derive('df-pdf-doc', 'pdf'))
+        targets.append(('df-pdf-doc', 'pdf'))
 
     ## vector image
     if ext in ('eps', 'svg'):
-        update_file(f.derive('pf-vector', 'svg'))
-        update_file(f.derive('df-pdf-vector', 'pdf'))
+        targets.append(('pf-vector', 'svg'))
+        targets.append(('df-pdf-vector', 'pdf'))
 
     ## video
     if ext in ('avi', 'flv', 'mov', 'mpeg', 'mp4', 'webm', 'ogv'):
-        update_file(f.derive('df-360p-vp9-400k', 'webm'))
-        update_file(f.derive('df-h264', 'mp4'))
+        targets.append(('df-360p-vp9-400k', 'webm'))
+        targets.append(('df-h264', 'mp4'))
+
+        # The still is also made by the thumbs function, from the frame in
+        # the middle of the video; if it is due, it is made from the same
+        # decode as the other video derivatives
+        if getattr(f, 'duration', None):
+            targets.append(('df-img-still', 'jpg'))
 
-        # This is in the thumbs function
-        # update_file(f.derive('df-img-still', 'jpg', frame))
+    return targets
+
+def derive_plan(fn):
+    """Return an :py:class:`odea.DerivePlan` of the derivatives for a
+    file."""
+    check_file(fn)
+    f = odea.load_file(fn)
+    plan = odea.DerivePlan(f)
+    for target, ext in derive_targets(f):
+        frame = None
+        if target == 'df-img-still':
+            # the same frame as in odea.File.thumbs()
+            frame = int(float(f.duration) // 2)
+        plan.add(target, target, ext, frame=frame)
+    return plan
+
+def run_plans(plans):
+    """Generate the derivatives in several plans. Return the number of
+    derivatives that could not be generated.
+
+    Only derivatives that are missing, or out of date with respect to the
+    file or their command, are generated. Afterwards, cached derivatives that
+    are no longer in the bag are removed from the
+    :py:class:`odea.DerivativeCache`. The derivatives of all the files
+    are run in parallel by an :py:class:`odea.DeriveScheduler`, and recorded
+    in the file metadata as each one finishes.
+    """
+    failed = 0
+    # the jobs are recorded, so that they can be resumed if interrupted
+    with odea.JobQueue() as queue:
+        results = odea.run_plans(plans, odea.DeriveScheduler(queue=queue))
+    # drop the cached copies of derivatives that have been replaced or
+    # deleted, which would otherwise use space in the cache indefinitely
+    if odea.DERIVATIVE_CACHE:
+        pruned = odea.DerivativeCache().prune()
+        if pruned:
+            print("Removed {} unused derivatives from the cache".format(
+                    pruned))
+    for plan, results in zip(plans, results):
+        for target, result in results.items():
+            if result is None:
+                print("Could not derive {} from {}".format(
+                        target, plan.file.filename))
+                failed += 1
+    return failed
+
+def derive(fn):
+    """Generate derivatives for a file."""
+    return run_plans([derive_plan(fn)])
 
 def publish(fn):
     """Create the HTML item description page matching a file."""
@@ -164,6 +252,206 @@ def index(path):
         os.unlink(index_file)
     os.link(html_file, index_file)
 
+def manifest(path):
+    """Update the bag payload and tag manifests, rehashing only new or
+    changed files."""
+
+    try:
+        os.chdir(odea.get_root(path))
+    except:
+        sys.exit("Could not change directory to {}".format(path))
+    b = odea.load_bag()
+    try:
+        report = b.update_manifest()
+        print("Manifest updated: {reused} reused, {rehashed} rehashed".format(
+                **report))
+        report = b.update_tagmanifest()
+    except odea.BagError as e:
+        sys.exit(str(e))
+    print("Tag manifest updated: {reused} reused, {rehashed} rehashed".format(
+            **report))
+
+def catalog(path):
+    """Rebuild the bag catalog from the tag files."""
+
+    try:
+        os.chdir(odea.get_root(path))
+    except:
+        sys.exit("Could not change directory to {}".format(path))
+    with odea.Catalog() as c:
+        c.rebuild()
+
+def pack(path):
+    """Move the item and file tag files into the packed metadata log, or
+    compact the log if the bag is already packed."""
+
+    try:
+        os.chdir(odea.get_root(path))
+    except:
+        sys.exit("Could not change directory to {}".format(path))
+    log = odea.get_metadata_log() or odea.MetadataLog()
+    count = log.pack(remove=True)
+    log.compact()
+    print("Packed {} tag files into {}".format(count, odea.METADATA_LOG))
+
+def unpack(path):
+    """Export the packed metadata log to the standard tag file layout."""
+
+    try:
+        os.chdir(odea.get_root(path))
+    except:
+        sys.exit("Could not change directory to {}".format(path))
+    log = odea.get_metadata_log()
+    if log is None:
+        sys.exit("{} not found".format(odea.METADATA_LOG))
+    count = log.export(remove=True)
+    print("Exported {} tag files".format(count))
+
+def expand(paths, root):
+    """Return the files named by <paths> relative to <root>, with directories
+    expanded to all the payload files they contain. Derivatives and hidden
+    files are skipped, as are paths outside the bag."""
+
+    filenames = []
+    for path in paths:
+        if odea.BagRoot.find(path) != root:
+            print("{} is not in the bag at {}".format(path, root.path))
+            continue
+        if not os.path.isdir(path):
+            filenames.append(root.relative(path))
+            continue
+        for d, dirs, files in os.walk(path):
+            rel = root.relative(d)
+            dirs[:] = sorted(x for x in dirs if not x.startswith('.') and
+                             os.path.join(rel, x) != odea.DERIV_DIR)
+            if rel != odea.DATA_DIR and not rel.startswith(
+                        odea.DATA_DIR + os.sep):
+                continue
+            filenames.extend(os.path.join(rel, fn) for fn in sorted(files)
+                             if not fn.startswith('.'))
+    return filenames
+
+def batch(filenames, args):
+    """Run the file commands (--update, --derive, --edit, --publish) on
+    each file in a single process. A file that fails is reported and left
+    out of the later steps; with more than one file, a summary is printed
+    at the end. Return the filenames (as renamed by --update), or exit
+    non-zero if any file failed."""
+
+    total = len(filenames)
+    counts = collections.Counter()
+    times = collections.Counter()
+
+    def phase(name, fn, function, *a):
+        start = time.monotonic()
+        try:
+            return function(fn, *a)
+        except (SystemExit, Exception) as e:
+            print("{}: {} failed: {}".format(fn, name, e))
+            counts['failed'] += 1
+        finally:
+            times[name] += time.monotonic() - start
+
+    if args.update:
+        updated = []
+        for fn in filenames:
+            tagged = re.search(odea.RE_UUID, os.path.basename(fn))
+            result = phase('update', fn, update, args.on_duplicate)
+            if result is not None:
+                updated.append(result)
+                counts['updated' if tagged else 'new'] += 1
+        filenames = updated
+
+    if args.derive:
+        # the derivatives of all the files are run together, in parallel
+        plans = []
+        for fn in filenames:
+            plan = phase('derive', fn, derive_plan)
+            if plan is not None:
+                plans.append(plan)
+        start = time.monotonic()
+        counts['derivatives failed'] = run_plans(plans)
+        times['derive'] += time.monotonic() - start
+
+    for name, function in (('edit', edit), ('publish', publish)):
+        if getattr(args, name):
+            for fn in filenames:
+                phase(name, fn, function)
+
+    if total > 1:
+        print("{} files: {} new, {} updated, {} failed".format(
+                total, counts['new'], counts['updated'], counts['failed']))
+        if counts['derivatives failed']:
+            print("{} derivatives could not be generated".format(
+                    counts['derivatives failed']))
+        print(', '.join('{} {:.1f}s'.format(name, t)
+                        for name, t in times.items()))
+    if counts['failed']:
+        sys.exit(1)
+    return filenames
+
+def resume(path):
+    """Run the derivation jobs left unfinished by an interrupted or failed
+    run, up to :py:data:`odea.DERIVE_MAX_ATTEMPTS` attempts each."""
+
+    try:
+        os.chdir(odea.get_root(path))
+    except:
+        sys.exit("Could not change directory to {}".format(path))
+    with odea.JobQueue() as queue:
+        scheduler = odea.DeriveScheduler(queue=queue)
+        for job in queue.unfinished():
+            if not os.path.exists(job['source']):
+                queue.finish(job['id'], 'failed', error='source missing')
+                continue
+            scheduler.submit(odea.load_file(job['source']), job['target'],
+                    job['ext'], job['frame'], save=bool(job['save']),
+                    resume=True, overwrite=True,
+                    target_dir=job['target_dir'] or None)
+        for job in scheduler.run():
+            if job.result is None:
+                print("Could not derive {} from {}".format(
+                        job.target, job.file.filename))
+        print("Jobs: {}".format(', '.join('{} {}'.format(n, state)
+                for state, n in sorted(queue.counts().items()))))
+
+def report(path):
+    """Print the number and total size of the payload files in the bag, by
+    format."""
+
+    try:
+        os.chdir(odea.get_root(path))
+    except:
+        sys.exit("Could not change directory to {}".format(path))
+    table = odea.FileTable.from_scan()
+    for format, (count, size) in table.summary().items():
+        print("{:<20} {:>8} {:>12}".format(format or '(untagged)', count,
+                odea._byte_size(size)))
+    print("{:<20} {:>8} {:>12}".format('total', len(table),
+            odea._byte_size(table.total_size())))
+
+def verify(path, mode='fast'):
+    """Validate the bag payload against its manifests, printing problems as
+    they are found. Exit non-zero if the bag is invalid."""
+
+    try:
+        os.chdir(odea.get_root(path))
+    except:
+        sys.exit("Could not change directory to {}".format(path))
+    b = odea.load_bag()
+    details = []
+    checked = 0
+    for fn, problem in b.iter_verify(full=(mode == 'full')):
+        checked += 1
+        if problem is not None:
+            details.append('{}: {}'.format(fn, problem))
+            print('FAIL {}: {}'.format(fn, problem), flush=True)
+    if details:
+        sys.exit(str(odea.BagValidationError(
+            'Bag validation failed ({} problems)'.format(len(details)),
+            details)))
+    print("Bag valid: {} files checked ({})".format(checked, mode))
+
 def main():
     parser = argparse.ArgumentParser(
             description='Command-line interface to the odea toolkit.')
@@ -172,43 +460,119 @@ def main():
                     help='initialize a new collection in <DIR>')
     parser.add_argument('--update', action='store_true',
                     help='import or update data from a source file')
+    parser.add_argument('--on-duplicate', action='store',
+                    choices=['refuse', 'link', 'remove'], default='refuse',
+                    help='what --update does with a file identical to an '
+                    'existing source: refuse it (the default), or record it '
+                    'as a copy in the existing item and move it to the '
+                    'duplicates directory (link) or delete it (remove)')
     parser.add_argument('--derive', action='store_true',
                     help='generate derivatives')
     parser.add_argument('--publish', action='store_true',
                     help='generate html item page for a source file')
     parser.add_argument('--edit', action='store_true',
                     help='open the item metadata page for a source file')
-    parser.add_argument('--filename', action='store',
-                    help='file to be processed by update/derive/publish, relative to the bag root')
+    parser.add_argument('--filename', action='store', nargs='+',
+                    help='file to be processed by update/derive/publish; '
+                    'several files, or directories containing them, can be '
+                    'given')
     parser.add_argument('--index', action='store_true',
                     help='generate html index for the collection')
+    parser.add_argument('--catalog', action='store_true',
+                    help='create or rebuild the catalog index for the collection')
+    parser.add_argument('--manifest', action='store_true',
+                    help='update the bag payload and tag manifests (only new or changed files are rehashed)')
+    parser.add_argument('--pack', action='store_true',
+                    help='store item and file metadata in a single '
+                    'append-only log instead of individual tag files')
+    parser.add_argument('--unpack', action='store_true',
+                    help='export the packed metadata log to individual tag '
+                    'files')
+    parser.add_argument('--verify', nargs='?', const='fast',
+                    choices=['fast', 'full'],
+                    help='validate the bag against its manifests; "fast" '
+                    '(the default) checks only that the listed files are '
+                    'present and match the Payload-Oxum in bag-info.txt '
+                    '(and their sizes '
+                    'when hashed, if this copy of the bag has a hash '
+                    'cache), "full" rehashes every file')
+    parser.add_argument('--resume', action='store_true',
+                    help='run the derivation jobs left unfinished by an '
+                    'interrupted run')
+    parser.add_argument('--report', action='store_true',
+                    help='report the number and size of payload files by '
+                    'format')
+    parser.add_argument('--workers', metavar='N', action='store', type=int,
+                    help='number of files to hash in parallel')
+    parser.add_argument('--jobs', metavar='N', action='store', type=int,
+                    help='number of CPUs that derivation commands may use '
+                    'at once')
     parser.add_argument('--archive', action='store',
                     help='the name of the archive, for Bag creation',
                     default='Digital Archive')
 
     args = parser.parse_args()
 
+    if args.workers:
+        odea.HASH_WORKERS = args.workers
+
+    if args.jobs:
+        odea.DERIVE_CPU_BUDGET = args.jobs
+
     if args.new:
         odea.new(args.new, archive=args.archive)
 
     if (args.update or args.derive or args.publish or
-                args.index) and not args.filename:
+                args.index or args.catalog or args.manifest or args.verify or
+                args.pack or args.unpack or args.report or args.resume) and \
+                not args.filename:
         sys.exit("Please provide an input filename/path.")
 
-    if args.update:
-        args.filename = update(args.filename)
+    filenames = []
+    if args.filename:
+        # Work from the bag root, so filenames printed and passed between
+        # the steps below are relative to the root
+        root = odea.BagRoot.find(args.filename[0])
+        if root is None:
+            sys.exit("Could not locate bag root for {}".format(
+                        args.filename[0]))
+        if args.update or args.derive or args.edit or args.publish:
+            filenames = expand(args.filename, root)
+        args.filename = root.relative(args.filename[0])
+        os.chdir(root.path)
+
+    if args.pack:
+        pack(args.filename)
+
+    if args.unpack:
+        unpack(args.filename)
+
+    if args.catalog:
+        catalog(args.filename)
+
+    if args.resume:
+        resume(args.filename)
+
+    if filenames:
+        filenames = batch(filenames, args)
+        # the first file may have been renamed by --update
+        if filenames:
+            args.filename = filenames[0]
 
-    if args.derive:
-        derive(args.filename)
+    if args.index:
+        index(args.filename)
 
-    if args.edit:
-        edit(args.filename)
+    if args.manifest:
+        manifest(args.filename)
 
-    if args.publish:
-        publish(args.filename)
+    if args.verify:
+        verify(args.filename, args.verify)
 
-    if args.index:
-        index(args.filename)
+    if args.report:
+        report(args.filename)
+
+    # keep the parsed tag files for the next run
+    odea.save_tag_snapshots()
 
 if __name__ == "__main__":
     main()
@@ -8,6 +8,23 @@ documents -- storage, indexing, validation, conversion to distribution formats,
 metadata cataloguing -- in ways that allow everything to remain accessible from
 the computer file system and open to manipulation with standard tools.
 
+The paths of the static resources below are computed from the package location
+the first time they are used; any of them can be overridden by assigning to
+the attribute (e.g. ``odea.PANDOC_CSS = 'my.css'``).
+
+.. data:: DOCUTILS_CSS
+
+   Docutils css.
+
+.. data:: DOCUTILS_TEMPLATE
+
+   Docutils page template. This template provides a "viewport" meta tag to
+   enable responsive display.
+
+.. data:: PANDOC_CSS
+
+   Pandoc css.
+
 """
 
 
@@ -20,9 +37,7 @@ the computer file system and open to manipulation with standard tools.
 #     :py:class:`odea.File`
 #         a File on disk, constituting a version of the Item
 
-import jsons #FIXME: Remove this dependency
 import json
-from dataclasses import dataclass, field
 from typing import List
 import hashlib
 import uuid
@@ -32,20 +47,25 @@ import datetime as dt
 from datetime import datetime # needed for the type hint
 from fnmatch import fnmatch
 import re
-import dbm
 import subprocess
 import tempfile
 import shutil
-import mimetypes
-
-from bs4 import BeautifulSoup
-from PIL import Image
+import threading
+import time
+import mmap
+import contextlib
+import collections
+import marshal
+import array
+
+# Third-party modules (bs4, PIL, slugify, pkg_resources) and the
+# standard modules dbm, mimetypes, sqlite3, and concurrent.futures are
+# imported where they are used, so that starting the command-line tool
+# stays fast.
 #import soundfile
 import pathlib
-import pkg_resources
 import textwrap
 import logging
-from slugify import slugify
 
 logger = logging.getLogger('odea')
 ch = logging.StreamHandler()
@@ -71,10 +91,69 @@ DATA_DIR = 'data'
 #: stored on generation.
 DERIV_DIR = os.path.join(DATA_DIR, 'deriv')
 
+#: The subdirectory of the bag, outside the payload, to which copies of files
+#: already in the bag are moved when they are imported as duplicates (see
+#: :py:meth:`File.add_duplicate`).
+DUPLICATES_DIR = 'duplicates'
+
 #: The subdirectory of the bag in which generated html metadata files will
 #: be stored.
 HTML_DIR = 'html'
 
+#: The subdirectory of the bag in which odea keeps private caches and indexes.
+#: Everything in this directory can be regenerated from the bag contents, and
+#: it is not included in the bag manifests.
+CACHE_DIR = '.odea'
+
+#: Persistent cache of file digests, keyed by filename and validated against
+#: the size, modification time, and inode of the file on disk.
+HASH_CACHE = os.path.join(CACHE_DIR, 'hashcache')
+
+#: SQLite catalog of the items and files in the bag. The catalog is optional:
+#: it is only used if it exists, and can be rebuilt at any time from the tag
+#: files with :py:meth:`Catalog.rebuild`.
+CATALOG = os.path.join(CACHE_DIR, 'catalog.sqlite')
+
+#: Index of the sha256 digests of all source ("SRC") files in the bag, used to
+#: detect duplicates at ingest. It is rebuilt from the file tag files if it is
+#: missing.
+SRC_INDEX = os.path.join(CACHE_DIR, 'srcindex')
+
+#: Record of the input and command each derivative was generated from, used
+#: to find derivatives that are out of date. Derivatives without a record
+#: (e.g. if the index is deleted) are assumed to be current.
+DERIVATION_INDEX = os.path.join(CACHE_DIR, 'derivations')
+
+#: Directory of previously generated derivatives, hard-linked by the digest
+#: of their input and command (see :py:class:`DerivativeCache`), so that
+#: renamed or re-imported files do not need to be converted again. Set to
+#: None to disable the cache.
+DERIVATIVE_CACHE = os.path.join(CACHE_DIR, 'derivatives')
+
+#: SQLite record of the derivation jobs run in the bag, with their state, so
+#: that an interrupted batch can be resumed (see :py:class:`JobQueue`).
+JOB_QUEUE = os.path.join(CACHE_DIR, 'jobs.sqlite')
+
+#: Number of times a derivation job is attempted before
+#: :py:meth:`JobQueue.unfinished` gives up on it.
+DERIVE_MAX_ATTEMPTS = 3
+
+#: Snapshot of the parsed contents of the item and file tag files, written
+#: with :py:mod:`marshal` so a new process can load them all in a single read.
+#: Each entry is checked against the size and modification time of its tag
+#: file before use. Set to None to disable the snapshot.
+TAG_SNAPSHOT = os.path.join(CACHE_DIR, 'tags.marshal')
+
+#: Packed metadata log in the bag root. If this file exists, item and file
+#: metadata are appended to it as JSON lines by :py:meth:`Item.save` and
+#: :py:meth:`File.save` instead of being written to individual tag files
+#: (see :py:class:`MetadataLog`).
+METADATA_LOG = 'metadata-log.jsonl'
+
+#: The :py:class:`MetadataLog` is compacted when it holds more than this many
+#: records for every current entry (and at least 1000 records).
+METADATA_LOG_COMPACT_RATIO = 2
+
 #: Regular expression for matching UUID identifiers in filenames.
 RE_UUID = re.compile("[0-F]{8}-[0-F]{4}-[0-F]{4}-[0-F]{4}-[0-F]{12}", re.I)
 
@@ -83,15 +162,97 @@ RE_HASHTAG = re.compile(r'(#[\w\d\-_]+)', flags=re.UNICODE)
 
 RE_URL = r'<((http://|https://|mailto:)(.*?))>'
 
-# Algorithms to be used in preparing bag manifests.
-# For BagIt standard compliance, this must include sha256 or sha512.
-# Available algorithms are: sha1, sha224, sha256, sha384, sha512, blake2b,
-# blake2s, and md5.
-# DEFAULT_CHECKSUMS = ["sha256", "sha512"]
+#: Algorithms computed together, in a single read, by
+#: :py:meth:`File.get_checksums`. For BagIt standard compliance, this must
+#: include sha256 or sha512.
+#: Available algorithms are: sha1, sha224, sha256, sha384, sha512, blake2b,
+#: blake2s, and md5.
+DEFAULT_CHECKSUMS = ["sha256", "sha512"]
 
-#: Block size used when reading files for hashing.
+#: Block size used when reading files for hashing. Each hashing thread reads
+#: into a single reused buffer of this size.
 HASH_BLOCK_SIZE = 512 * 1024
 
+#: Files at least this large (in bytes) are memory-mapped for hashing rather
+#: than read into a buffer, which avoids copying the data into user space. Set
+#: to None to disable memory mapping.
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+
+#: Number of worker threads used for hashing files in parallel. hashlib
+#: releases the GIL while digesting, so this scales with cores and disks.
+HASH_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+#: Maximum number of files hashed concurrently on any single storage device
+#: (as identified by ``st_dev``). Keep this low for spinning disks.
+HASH_DEVICE_CONCURRENCY = 4
+
+#: Number of CPUs that derivation commands may keep busy at once, when many
+#: derivatives are generated by a :py:class:`DeriveScheduler`.
+DERIVE_CPU_BUDGET = os.cpu_count() or 1
+
+#: Number of CPUs assumed to be used by one command of each tool (the first
+#: program named in the command). Tools not listed count as one.
+DERIVE_TOOL_COST = {
+    'ffmpeg': 4,
+}
+
+#: Maximum number of commands of each tool run at the same time by a
+#: :py:class:`DeriveScheduler`. LibreOffice refuses to run more than one
+#: instance with the same user profile.
+DERIVE_TOOL_LIMITS = {
+    'libreoffice': 1,
+    'ffmpeg': max(1, (os.cpu_count() or 1) // 4),
+    'wkhtmltoimage': 2,
+    'wkhtmltopdf': 2,
+    'inkscape': 2,
+}
+
+#: Time limits for derivation commands, by target, as a tuple of (seconds,
+#: seconds per MiB of input, seconds per second of media duration). The
+#: duration is taken from :py:attr:`File.duration` if known, and otherwise
+#: estimated from the size of the input at one second per MiB. Targets not
+#: listed use :py:data:`DERIVE_TIMEOUT_DEFAULT`.
+DERIVE_TIMEOUTS = {
+    'DF_H264': (300, 0, 3),
+    'DF_H264_CONCAT': (300, 0, 3),
+    'DF_360P_VP9_400K': (300, 0, 4),
+    'PF_FFV1': (300, 0, 2),
+    'PF_WAV': (60, 0, 0.5),
+    'DF_MP3': (60, 0, 0.5),
+    'DF_IMG_STILL': (60, 0, 0),
+    'DF_IMG_STILLS': (120, 0, 1),
+    'DF_PDF_DOC': (120, 2, 0),
+    'PF_WEBARC': (1800, 0, 0),
+}
+
+#: Time limit for derivation commands not listed in :py:data:`DERIVE_TIMEOUTS`.
+DERIVE_TIMEOUT_DEFAULT = (30, 1, 0)
+
+#: Seconds a derivation command is given to exit after it is asked to stop
+#: (with SIGTERM), before it is killed.
+DERIVE_KILL_GRACE = 5
+
+#: Videos at least this long, in seconds, are encoded in segments, in
+#: parallel, for the targets in :py:data:`CHUNKED_TARGETS`. None disables
+#: chunked encoding.
+DERIVE_CHUNK_MIN_DURATION = 1200
+
+#: Approximate length of each segment, in seconds. The source is cut at the
+#: first keyframe after each multiple of this length.
+DERIVE_CHUNK_SECONDS = 300
+
+#: Number of segments encoded at the same time. Chunked encoding is not used
+#: if this is less than 2 (on machines with fewer than 8 CPUs, by default).
+DERIVE_CHUNK_WORKERS = max(1, DERIVE_CPU_BUDGET // DERIVE_TOOL_COST['ffmpeg'])
+
+#: Largest difference, in seconds, allowed between the durations of a video
+#: and its chunked derivative.
+DERIVE_CHUNK_TOLERANCE = 1.0
+
+#: Maximum number of parsed tag files kept in memory by
+#: :py:data:`tag_cache`. The least recently used entries are dropped first.
+TAG_CACHE_SIZE = 4096
+
 #: List of metadata terms used in preparing html output for items.
 #: These will correspond to the item properties but are listed here in
 #: presentation order.
@@ -104,15 +265,28 @@ TERMS = [ 'dcmi_type', 'title', 'identifier', 'creator', 'subject', 'contributor
 # #: The default stylesheet is Bootstrap v5.
 # ODEA_CSS = pkg_resources.resource_filename('odea', "static/bootstrap.min.css")
 
-#: Docutils css. This path is computed from the package location.
-DOCUTILS_CSS = pkg_resources.resource_filename('odea', "static/docutils_odea.css")
-
-#: Docutils page template. This path is computed from the package location.
-#: This template provides a "viewport" meta tag to enable responsive display.
-DOCUTILS_TEMPLATE = pkg_resources.resource_filename('odea', "static/docutils_template.txt")
-
-#: Pandoc css. This path is computed from the package location.
-PANDOC_CSS = pkg_resources.resource_filename('odea', "static/pandoc_odea.css")
+# Static resources, available as module attributes (documented in the module
+# docstring). The paths are computed the first time they are used, since
+# loading pkg_resources is slow.
+_STATIC_RESOURCES = {
+    'DOCUTILS_CSS': 'static/docutils_odea.css',
+    'DOCUTILS_TEMPLATE': 'static/docutils_template.txt',
+    'PANDOC_CSS': 'static/pandoc_odea.css',
+}
+
+def __getattr__(name):
+    """Resolve the static resource paths on first access."""
+    if name in _STATIC_RESOURCES:
+        import pkg_resources
+        path = pkg_resources.resource_filename('odea', _STATIC_RESOURCES[name])
+        globals()[name] = path
+        return path
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+                            __name__, name))
+
+def _static(name):
+    """Return the path of a static resource (see :py:func:`__getattr__`)."""
+    return getattr(sys.modules[__name__], name)
 
 #: Custom CSS to be added to html output (currently bases Bootstrap 5).
 CSS = """q::before { content: none; } q::after { content: none; } q{font-style: italic}'"""
@@ -124,6 +298,10 @@ CSS = """q::before { content: none; } q::after { content: none; } q{font-style:
 HTML_TEMPLATE = """<!doctype html> <html lang="en"> <head> <meta charset="utf-8"> <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no"> <link rel="stylesheet" href="bootstrap.min.css"> <style>{css}</style> <title>{title} - {archive}</title> </head> <body> <nav class="navbar navbar-expand-lg navbar-dark bg-primary"> <div class="container"> <a class="navbar-brand" href="{archive_url}">{archive}</a> </div> </nav> <div class="container py-4"> {nav} <h1>{title}</h1> {body} </div> <footer class="footer mt-5 p-3"> <div class="container"> <p class="text-muted">{page_metadata}</p> <p class="text-muted">{license}</span> </div> </footer> </body> </html>
 """
 
+# Shell commands for the derivation targets. Targets that have a Converter in
+# CONVERTERS (below) are run from there, without a shell; these commands are
+# the fallback for the other targets.
+
 # FIXME: PDF policy <https://cromwell-intl.com/open-source/pdf-not-authorized.html>
 #: Shell command for deriving a thumbnail image from a source file. This will crop the image if it does not fit the bounding box.
 CMD_DF_IMG_THUMB = 'convert "{source}[{frame}]" -density 300 -thumbnail 360x360^ -gravity center -extent 360x360 -background white -alpha remove -auto-orient {target}'
@@ -226,14 +404,268 @@ CMD_DF_IMG_STILLS = 'mkdir {target}; ffmpeg -i "{source}" -vf fps=1/6,scale=-1:3
 #: The ``--stylesheet`` value is obtained from the variable
 #: :py:data:`DOCUTILS_CSS`, which defaults to the file ``/static/
 #: docutils_odea.css`` in the odea package.
-CMD_DF_DOCUTILS_HTML = 'rst2html5 --date --smart-quotes=yes --template="' + DOCUTILS_TEMPLATE +'" --stylesheet-path="' + DOCUTILS_CSS + '" "{source}" "{target}"'
+CMD_DF_DOCUTILS_HTML = 'rst2html5 --date --smart-quotes=yes --template="{docutils_template}" --stylesheet-path="{docutils_css}" "{source}" "{target}"'
 
 #: Shell command to convert Markdown, ReStructured Text, or any other plain-
 #: text format to html via Pandoc.
 #: The ``-c`` (css) value is obtained from the variable
 #: :py:data:`PANDOC_CSS`, which defaults to the file ``/static/
 #: pandoc_odea.css`` in the odea package.
-CMD_DF_PANDOC_HTML = 'pandoc -o "{target}" -t html5 -c "' + PANDOC_CSS + '" --standalone "{source}"'
+CMD_DF_PANDOC_HTML = 'pandoc -o "{target}" -t html5 -c "{pandoc_css}" --standalone "{source}"'
+
+
+### CONVERTERS
+
+class Converter:
+    """A derivation command, run directly rather than through a shell.
+
+    :param stages: The command as a list of arguments, or a pipeline as a
+                   list of such lists, in which the standard output of each
+                   command is connected to the standard input of the next.
+
+    :param stdin:  If True, the source file is passed to the (first) command
+                   on its standard input, instead of by name.
+
+    :param stdout: If True, the standard output of the (last) command is
+                   written to the target file, instead of the command
+                   writing the file itself.
+
+    :param output: For commands that choose the name of their output file,
+                   the name of the file they write (relative to the bag
+                   root), which is then moved to the target.
+
+    Each argument is formatted with the fields ``{source}`` and ``{target}``
+    (relative to the bag root), ``{frame}``, ``{stem}`` (the name of the
+    source without its directory and extension), ``{outdir}`` (an empty
+    temporary directory, removed afterwards), ``{url}`` (the first line of the
+    source file), and the static resources (e.g. ``{pandoc_css}``). Since no
+    shell is involved, filenames containing quotes or spaces need no escaping.
+
+        >>> import odea
+        >>> c = odea.Converter([['echo', '{source}'], ['tr', 'a-z', 'A-Z']],
+        ...                    stdout=True)
+        >>> print(c)
+        echo {source} | tr a-z A-Z > {target}
+
+    """
+
+    def __init__(self, stages, stdin=False, stdout=False, output=None):
+        if stages and isinstance(stages[0], str):
+            stages = [stages]
+
+        #: The commands of the pipeline, as lists of arguments.
+        self.stages = [list(stage) for stage in stages]
+
+        #: Whether the source is read from standard input.
+        self.stdin = stdin
+
+        #: Whether the target is written from standard output.
+        self.stdout = stdout
+
+        #: The file written by the command, if not the target.
+        self.output = output
+
+    def __str__(self):
+        import shlex
+        cmd = ' | '.join(' '.join(shlex.quote(a) if '{' not in a else a
+                         for a in stage) for stage in self.stages)
+        if self.stdin:
+            cmd += ' < {source}'
+        if self.stdout:
+            cmd += ' > {target}'
+        if self.output:
+            cmd += ' # {}'.format(self.output)
+        return cmd
+
+    def __repr__(self):
+        return 'Converter({!r})'.format(str(self))
+
+    def run(self, fields, timeout, cwd=None):
+        """Run the command, with the arguments formatted with <fields>.
+        Return a ``subprocess.CompletedProcess`` whose return code is the
+        first non-zero return code in the pipeline. ``subprocess.TimeoutExpired``
+        is raised if the pipeline does not finish within <timeout> seconds,
+        once all its commands have been stopped (see :py:func:`_run_command`).
+        """
+
+        fields = dict(fields)
+        source = _path_in(cwd, fields['source'])
+        target = _path_in(cwd, fields['target'])
+        fields.setdefault('stem',
+                os.path.splitext(os.path.basename(fields['source']))[0])
+        if any('{url}' in a for stage in self.stages for a in stage):
+            with open(source) as f:
+                fields['url'] = f.readline().strip()
+
+        outdir = None
+        if self.output or any('{outdir}' in a for stage in self.stages
+                              for a in stage):
+            outdir = tempfile.mkdtemp(prefix='.odea-tmp-',
+                                      dir=os.path.dirname(target) or '.')
+            fields['outdir'] = os.path.relpath(outdir, cwd or '.')
+
+        argvs = [[a.format(**fields) for a in stage] for stage in self.stages]
+        try:
+            returncode = self._run(argvs, source, target, timeout, cwd)
+            if returncode == 0 and self.output:
+                output = self.output.format(**fields)
+                if os.path.exists(_path_in(cwd, output)):
+                    os.replace(_path_in(cwd, output), target)
+                else:
+                    logger.error('{} did not write {}'.format(argvs[0][0],
+                                                              output))
+                    returncode = 1
+        finally:
+            if outdir is not None:
+                shutil.rmtree(outdir, ignore_errors=True)
+        return subprocess.CompletedProcess(argvs, returncode)
+
+    def _run(self, argvs, source, target, timeout, cwd):
+        """Start the commands of the pipeline, connected by pipes, and wait
+        for them. Return the return code."""
+        files = []
+        procs = []
+        try:
+            stdin = None
+            if self.stdin:
+                stdin = open(source, 'rb')
+                files.append(stdin)
+            for n, argv in enumerate(argvs):
+                stdout = None
+                if n < len(argvs) - 1:
+                    stdout = subprocess.PIPE
+                elif self.stdout:
+                    stdout = open(target, 'wb')
+                    files.append(stdout)
+                proc = subprocess.Popen(argv, stdin=stdin, stdout=stdout,
+                        cwd=cwd, start_new_session=(os.name == 'posix'))
+                procs.append(proc)
+                if n > 0:
+                    stdin.close() # the next command holds the pipe
+                stdin = proc.stdout
+            return _wait_processes(procs, timeout)
+        except OSError as e:
+            # e.g. the program is not installed
+            logger.error('Could not run {}: {}'.format(argv[0], e))
+            for proc in procs:
+                _kill_group(proc)
+            return 127
+        finally:
+            for f in files:
+                f.close()
+
+def _path_in(directory, filename):
+    """Return <filename> relative to <directory> (the current directory if
+    None)."""
+    return os.path.join(directory, filename) if directory else filename
+
+#: Derivation commands by target, run by :py:meth:`File.derive` without a
+#: shell. These take precedence over the shell commands in the ``CMD_<TARGET>``
+#: variables, which are used for targets not listed here (and can be used
+#: instead by deleting a target from this dict).
+CONVERTERS = {
+    'DF_IMG_THUMB': Converter(['convert', '{source}[{frame}]', '-density',
+        '300', '-thumbnail', '360x360^', '-gravity', 'center', '-extent',
+        '360x360', '-background', 'white', '-alpha', 'remove', '-auto-orient',
+        '{target}']),
+    'DF_IMG_MED': Converter(['convert', '{source}[{frame}]', '-density',
+        '300', '-resize', '800x600>', '-background', 'white', '-alpha',
+        'remove', '-auto-orient', '{target}']),
+    'DF_IMG_LG': Converter(['convert', '{source}[{frame}]', '-density', '300',
+        '-resize', '1920x1080>', '-background', 'white', '-alpha', 'remove',
+        '-auto-orient', '{target}']),
+    'PF_TIFF': Converter(['convert', '-compress', 'none', '{source}[{frame}]',
+        '{target}']),
+    'PF_WEBARC': Converter(['wget', '--input-file={source}', '--convert-links',
+        '--page-requisites', '--span-hosts', '--adjust-extension',
+        '--restrict-file-names=windows', '--directory-prefix={target}']),
+    'PF_WAV': Converter(['ffmpeg', '-nostdin', '-i', '{source}', '{target}']),
+    'DF_MP3': Converter(['ffmpeg', '-nostdin', '-i', '{source}', '{target}']),
+    # LibreOffice names its output after the source, so it is written to a
+    # temporary directory and moved
+    'DF_PDF_DOC': Converter(['libreoffice', '--headless', '--convert-to',
+        'pdf', '--outdir', '{outdir}', '{source}'],
+        output='{outdir}/{stem}.pdf'),
+    'DF_IMG_SCREENSHOT': Converter(['xvfb-run', '-a', '--', 'wkhtmltoimage',
+        '--crop-h', '800', '--quality', '60', '{source}', '{target}']),
+    'DF_PDF_WKHTML': Converter(['xvfb-run', '-a', '--', 'wkhtmltopdf',
+        '--print-media-type', '{source}', '{target}']),
+    'DF_PDF_HTML': Converter(['wkhtmltopdf', '{url}', '{target}']),
+    'PF_SCREENSHOT': Converter(['wkhtmltoimage', '{url}', '{target}']),
+    'DF_SCREENSHOT_CROPPED': Converter(['wkhtmltoimage', '{url}', '--crop-h',
+        '800', '--quality', '60', '{target}']),
+    'DF_PDF_VECTOR': Converter(['inkscape', '{source}',
+        '--export-pdf={target}']),
+    'PF_VECTOR': Converter(['inkscape', '{source}',
+        '--export-plain-svg={target}']),
+    'DF_H264': Converter(['ffmpeg', '-loglevel', 'panic', '-nostdin', '-i',
+        '{source}', '-vcodec', 'libx264', '-acodec', 'aac', '-ab', '384K',
+        '-crf', '21', '-bf', '2', '-flags', '+cgop', '-pix_fmt', 'yuv420p',
+        '-movflags', 'faststart', '{target}']),
+    'DF_H264_CONCAT': Converter(['ffmpeg', '-loglevel', 'panic', '-nostdin',
+        '-f', 'concat', '-segment_time_metadata', '1', '-i', '{source}',
+        '-vcodec', 'libx264', '-acodec', 'aac', '-ab', '384K', '-crf', '21',
+        '-bf', '2', '-flags', '+cgop', '-pix_fmt', 'yuv420p', '-movflags',
+        'faststart', '{target}']),
+    'DF_360P_VP9_400K': Converter(['ffmpeg', '-loglevel', 'panic', '-nostdin',
+        '-i', '{source}', '-codec:v', 'libvpx-vp9', '-b:v', '400K', '-crf',
+        '31', '-speed', '4', '-tile-columns', '6', '-frame-parallel', '1',
+        '-vf', 'scale=-1:360', '-f', 'webm', '{target}']),
+    'PF_FFV1': Converter(['ffmpeg', '-loglevel', 'panic', '-nostdin', '-i',
+        '{source}', '-vcodec', 'ffv1', '-acodec', 'pcm_s16le', '{target}']),
+    'DF_IMG_STILL': Converter(['ffmpeg', '-loglevel', 'panic', '-nostdin',
+        '-ss', '{frame}.0', '-i', '{source}', '-frames:v', '1', '{target}']),
+    'DF_DOCUTILS_HTML': Converter(['rst2html5', '--date',
+        '--smart-quotes=yes', '--template={docutils_template}',
+        '--stylesheet-path={docutils_css}', '{source}', '{target}']),
+    'DF_PANDOC_HTML': Converter(['pandoc', '-o', '{target}', '-t', 'html5',
+        '-c', '{pandoc_css}', '--standalone', '{source}']),
+}
+
+#: The combined video derivation (see :py:meth:`File.derive_video`), which
+#: generates any of the :py:data:`VIDEO_TARGETS` from a single decode of the
+#: source.
+VIDEO_TARGET = 'DF_VIDEO'
+
+#: Targets that can be generated together by :py:data:`VIDEO_TARGET`, with
+#: their extensions. Each must have an ffmpeg converter in
+#: :py:data:`CONVERTERS` of the form ``ffmpeg [options] -i {source} [output
+#: options] {target}``.
+VIDEO_TARGETS = collections.OrderedDict([
+    ('DF_360P_VP9_400K', 'webm'),
+    ('DF_H264', 'mp4'),
+    ('DF_IMG_STILL', 'jpg'),
+])
+
+#: Targets that can be encoded in segments (see
+#: :py:data:`DERIVE_CHUNK_MIN_DURATION`), with the ffmpeg options used when
+#: the segments are joined. The segments are encoded without sound, with the
+#: output options of the target's converter; the sound is encoded in a single
+#: pass as they are joined, so that there are no gaps at the joins.
+CHUNKED_TARGETS = {
+    'DF_H264': ['-acodec', 'aac', '-ab', '384K', '-movflags', 'faststart'],
+}
+
+def _video_output_options(target):
+    """Return the ffmpeg options of the converter for <target> that apply to
+    its output, for use in a command with several outputs. A seek before the
+    input (``-ss``) becomes a seek in the output.
+
+        >>> import odea
+        >>> odea._video_output_options('DF_IMG_STILL')
+        ['-ss', '{frame}.0', '-frames:v', '1']
+
+    """
+    argv = CONVERTERS[target].stages[0]
+    i = argv.index('-i')
+    if argv[0] != 'ffmpeg' or argv[i + 1] != '{source}' or \
+                argv[-1] != '{target}':
+        raise ValueError('{} cannot be combined'.format(target))
+    pre = argv[1:i]
+    options = []
+    if '-ss' in pre:
+        options += pre[pre.index('-ss'):pre.index('-ss') + 2]
+    return options + argv[i + 2:-1]
 
 NIL_UUID = '0000000-0000-0000-0000-000000000000'
 
@@ -308,6 +740,7 @@ def load_sample_file(filename):
     :py:data:`File.identifier`, :py:data:`File.format`, :py:data:`File.size`, :py:data:`File.sha256`.
     """
 
+    import pkg_resources
     src = pkg_resources.resource_filename('odea', 'test/{}'.format(filename))
     fn = os.path.join(DATA_DIR, filename)
     shutil.copyfile(src, fn)
@@ -427,10 +860,92 @@ def get_root(path):
 
     return None
 
+class BagRoot:
+    """A handle on the root directory of a bag on disk.
+
+    File, Item, and Bag objects loaded with a BagRoot access the bag through
+    absolute paths built from it, rather than relying on the current working
+    directory, so several threads can work on one or several bags in the
+    same process. Filenames stored in metadata remain relative to the root.
+
+    :param path: The absolute path of the bag root. Use :py:meth:`find` to
+                 locate the root from any path within the bag.
+
+        >>> import odea, os
+        >>> b = odea.test_bag()
+        >>> root = odea.BagRoot.find(os.path.join('data', 'spam.txt'))
+        >>> root.path == os.getcwd()
+        True
+        >>> root.join('data', 'spam.txt') == os.path.join(os.getcwd(), 'data', 'spam.txt')
+        True
+        >>> odea.BagRoot.find('data') is root
+        True
+
+    """
+
+    _roots = {}
+    _found = {}
+    _found_lock = threading.Lock()
+
+    def __init__(self, path):
+
+        #: Absolute path to the bag root.
+        self.path = path
+
+    def __repr__(self):
+        return 'BagRoot({!r})'.format(self.path)
+
+    def __eq__(self, other):
+        return isinstance(other, BagRoot) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def join(self, *parts):
+        """Return the absolute path of <parts> within the bag."""
+        return os.path.join(self.path, *parts)
+
+    def relative(self, filename):
+        """Return <filename> (absolute, or relative to the current directory)
+        relative to the bag root."""
+        p = os.path.abspath(filename)
+        if not p.startswith(self.path + os.sep):
+            p = os.path.realpath(filename)
+        return os.path.relpath(p, self.path)
+
+    @classmethod
+    def find(cls, path):
+        """Return the BagRoot of the bag containing <path>, or None.
+
+        The root is resolved with :py:func:`get_root` once per directory and
+        remembered, so repeated lookups cost a single ``stat``.
+        """
+
+        p = os.path.abspath(path)
+        d = p if os.path.isdir(p) else os.path.dirname(p)
+        root = cls._found.get(d)
+        if root is None:
+            path = get_root(d)
+            if path is None:
+                return None
+            with cls._found_lock:
+                root = cls._roots.setdefault(path, cls(path))
+                cls._found[d] = root
+        return root
+
+def _path(root, *parts):
+    """Return the path of <parts> within the bag at <root> (a
+    :py:class:`BagRoot`), or relative to the current directory if <root> is
+    None."""
+    if root is None:
+        return os.path.join(*parts)
+    return root.join(*parts)
+
 def _prettify(html):
     """Run an html string through BeautifulSoup to prettify it.
     """
 
+    from bs4 import BeautifulSoup
     bs = BeautifulSoup(html, 'html.parser')
     return bs.prettify()
 
@@ -511,19 +1026,271 @@ def _isotime(timestamp):
     t = datetime.fromtimestamp(int(timestamp))
     return t.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-def _get_hash(filename, hashtype):
-    """Retrieve the hash of a file, using a hashtype known to hashlib. """
-    m = hashlib.new(hashtype)
+def _stat_key(st):
+    """Return the (size, mtime_ns, inode) signature of an os.stat result."""
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def _load_manifest(manifest_file):
+    """Parse a BagIt manifest file. Return a dict of {filename: digest}."""
+
+    entries = {}
+    if not os.path.isfile(manifest_file):
+        return entries
+    with open(manifest_file, 'r') as manifest:
+        for line in manifest:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            digest, _, filename = line.partition(' ')
+            entries[filename.strip()] = digest.strip()
+    return entries
+
+_hash_buffers = threading.local()
+
+def _hash_buffer(block_size):
+    """Return a reusable read buffer for the calling thread."""
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None or len(buf) != block_size:
+        buf = bytearray(block_size)
+        _hash_buffers.buf = buf
+    return buf
+
+def _hash_readinto(fh, hashes, block_size):
+    """Feed a file to hash objects, reading into one reused buffer."""
+    buf = _hash_buffer(block_size)
+    view = memoryview(buf)
+    while True:
+        n = fh.readinto(buf)
+        if not n:
+            break
+        block = view[:n]
+        for h in hashes:
+            h.update(block)
+
+def _hash_mmap(fh, hashes, block_size):
+    """Feed a file to hash objects through a read-only memory map."""
+    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+            # hash block by block so that several digests share the data
+            # while it is still in the CPU cache
+            for offset in range(0, len(mm), block_size):
+                with view[offset:offset + block_size] as block:
+                    for h in hashes:
+                        h.update(block)
+
+def _read_hashes(filename, algs, block_size=None):
+    """Hash a file on the calling thread with several algorithms known to
+    hashlib, feeding each block read to every hash object. Return a dict of
+    {alg: hex digest}, or None if the file does not exist.
+
+    :param block_size: Read size in bytes. Defaults to
+                       :py:data:`HASH_BLOCK_SIZE`.
+
+    Files of at least :py:data:`HASH_MMAP_THRESHOLD` bytes are memory-mapped;
+    smaller files are read into a reused buffer.
+    """
     if not os.path.isfile(filename):
         return None
-    with open(filename, 'rb') as fh:
-        while True:
-            block = fh.read(HASH_BLOCK_SIZE)
-            if not block:
-                break
-            m.update(block)
-    return m.hexdigest()
+    if not block_size:
+        block_size = HASH_BLOCK_SIZE
+    m = [hashlib.new(alg) for alg in algs]
+    with open(filename, 'rb', buffering=0) as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if (HASH_MMAP_THRESHOLD is not None and size > 0
+                and size >= HASH_MMAP_THRESHOLD):
+            _hash_mmap(fh, m, block_size)
+        else:
+            _hash_readinto(fh, m, block_size)
+    return {alg: h.hexdigest() for alg, h in zip(algs, m)}
+
+def _read_hash(filename, hashtype):
+    """Hash a file on the calling thread, using a hashtype known to hashlib."""
+    digests = _read_hashes(filename, [hashtype])
+    if digests is None:
+        return None
+    return digests[hashtype]
+
+def _write_manifest(manifest_file, filenames, alg, root=None, stats=None):
+    """Write a BagIt manifest for <filenames>, hashing only files that are new
+    or have changed since they were last hashed. Return a tuple of a report
+    dict, giving the number of digests ``reused`` and files ``rehashed``, and
+    the total size of the files in bytes. :py:class:`BagError` is raised (and
+    the manifest is left unchanged) if any file cannot be read.
+
+    Digests of unchanged files are taken from the :py:class:`HashCache`,
+    which is kept up to date as files are hashed (e.g. by
+    :py:meth:`File.get_checksums`), rather than from the previous version of
+    the manifest. The manifest and
+    filenames are relative to <root> (a :py:class:`BagRoot`). <stats> may
+    map filenames to ``os.stat`` results already taken.
+    """
+
+    previous = _load_manifest(_path(root, manifest_file))
+    report = {'reused': 0, 'rehashed': 0}
+
+    digests = {}
+    stale = {}
+    octets = 0
+    with HashCache(root) as cache:
+        for fn in filenames:
+            st = stats[fn] if stats else os.stat(_path(root, fn))
+            octets += st.st_size
+            c = cache.get(fn, alg, st)
+            if c is not None:
+                # the cache is authoritative: get_checksums() may have
+                # rehashed a changed file since the manifest was written
+                digests[fn] = c
+                report['reused'] += 1
+            else:
+                stale[_path(root, fn)] = (fn, st)
+
+        # New and changed files are hashed in parallel
+        unreadable = []
+        for p, c in get_hash_engine().hash_files(stale, alg):
+            fn, st = stale[p]
+            if c is None:
+                unreadable.append(fn)
+                continue
+            digests[fn] = c
+            cache.set(fn, alg, c, st)
+            report['rehashed'] += 1
+
+    # a manifest without these files would not describe the bag
+    if unreadable:
+        raise BagError('Could not read {} files for {}: {}'.format(
+                len(unreadable), manifest_file, ', '.join(sorted(unreadable))))
+
+    m = ['{} {}'.format(digests[fn], fn) for fn in sorted(digests)]
+    with open(_path(root, manifest_file), 'w') as manifest:
+        manifest.write('\r\n'.join(m))
+    logger.info('Updated {}: {reused} reused, {rehashed} rehashed'.format(
+                    manifest_file, **report))
+    return report, octets
+
+def _get_hash(filename, hashtype):
+    """Retrieve the hash of a file, using a hashtype known to hashlib.
+
+    The file is hashed through the shared :py:class:`HashEngine`, so the
+    per-device concurrency limit applies.
+    """
+    return get_hash_engine().hash_file(filename, hashtype)
+
+######## HASH ENGINE ########
+
+class HashEngine:
+    """A bounded thread pool for hashing many files in parallel.
+
+    :param workers:    Number of worker threads. Defaults to
+                       :py:data:`HASH_WORKERS`.
+
+    :param per_device: Maximum number of files read at once from any one
+                       storage device. Defaults to
+                       :py:data:`HASH_DEVICE_CONCURRENCY`.
+
+        >>> import odea, os
+        >>> b = odea.test_bag()
+        >>> fns = [os.path.join('data', '{}.txt'.format(n)) for n in range(3)]
+        >>> for fn in fns:
+        ...     with open(fn, 'w') as out:
+        ...         o = out.write('spam')
+        >>> with odea.HashEngine(workers=2) as engine:
+        ...     sorted(engine.hash_files(fns, 'sha256'))[0]
+        ('data/0.txt', '4e388ab32b10dc8dbc7e28144f552830adc74787c1e2c0824032078a79f227fb')
+
+    """
+
+    def __init__(self, workers=None, per_device=None):
+
+        #: Number of worker threads.
+        self.workers = workers or HASH_WORKERS
+
+        #: Maximum number of concurrent reads per storage device.
+        self.per_device = per_device or HASH_DEVICE_CONCURRENCY
+
+        from concurrent import futures
+        self._pool = futures.ThreadPoolExecutor(max_workers=self.workers,
+                        thread_name_prefix='odea-hash')
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
+    def close(self):
+        """Shut down the worker threads."""
+        self._pool.shutdown(wait=True)
+
+    def _device(self, filename):
+        """Return the semaphore limiting reads from the device of <filename>."""
+        try:
+            dev = os.stat(filename).st_dev
+        except OSError:
+            dev = None
+        with self._lock:
+            if dev not in self._devices:
+                self._devices[dev] = threading.BoundedSemaphore(self.per_device)
+            return self._devices[dev]
+
+    def hash_file(self, filename, alg):
+        """Hash a single file on the calling thread. Return the hex digest, or
+        None if the file does not exist.
+
+        :param alg: A hashlib algorithm name, or a list of names to be
+                    computed in a single read of the file. If a list is given,
+                    a dict of {alg: hex digest} is returned.
+        """
+        with self._device(filename):
+            if isinstance(alg, str):
+                return _read_hash(filename, alg)
+            return _read_hashes(filename, alg)
+
+    def _hash_or_none(self, filename, alg):
+        try:
+            return (filename, self.hash_file(filename, alg))
+        except OSError as e:
+            logger.error('Could not hash {}: {}'.format(filename, e))
+            return (filename, None)
+
+    def hash_files(self, filenames, alg):
+        """Hash files in parallel. Yield ``(filename, digest)`` tuples in
+        order of completion. As for :py:meth:`hash_file`, <alg> may be a list
+        of algorithms, in which case each digest is a dict.
+
+        At most twice as many files as there are workers are queued at any one
+        time, so this can be used with a lazy iterable of any length. A file
+        that cannot be read yields a digest of None.
+        """
+
+        from concurrent import futures
+        pending = set()
+        for fn in filenames:
+            if len(pending) >= self.workers * 2:
+                done, pending = futures.wait(pending,
+                        return_when=futures.FIRST_COMPLETED)
+                for fut in done:
+                    yield fut.result()
+            pending.add(self._pool.submit(self._hash_or_none, fn, alg))
+        for fut in futures.as_completed(pending):
+            yield fut.result()
+
+_hash_engine = None
+_hash_engine_lock = threading.Lock()
+
+def get_hash_engine():
+    """Return the shared :py:class:`HashEngine`, creating it on first use with
+    the current values of :py:data:`HASH_WORKERS` and
+    :py:data:`HASH_DEVICE_CONCURRENCY`."""
+
+    global _hash_engine
+    with _hash_engine_lock:
+        if _hash_engine is None:
+            _hash_engine = HashEngine()
+        return _hash_engine
 
 def _default_items_list():
     """Return an empty list to instantiate a Bag."""
@@ -548,6 +1315,32 @@ def _byte_size(num):
         num /= 1024.0
     return "%.1f %s%s" % (num, 'Yi', suffix)
 
+def _filename_parts(filename, identifier=None):
+    """Split a filename of the form ``<basename>[.<format>][.<uuid>].<ext>``.
+    Return a tuple (basename, format, ext); format is None if absent.
+
+        >>> import odea
+        >>> odea._filename_parts('data/a.df-mp3.48342ee3-9080-407e-9862-12ce05143499.mp3',
+        ...     '48342ee3-9080-407e-9862-12ce05143499')
+        ('data/a', 'df-mp3', 'mp3')
+
+    """
+
+    if identifier and identifier in filename:
+        b, ext = filename.split(identifier)
+        base = b.strip('.')
+    else:
+        # we can have basename and format without UUID.
+        base, ext = os.path.splitext(filename)
+    ext = ext.strip('.')
+
+    try:
+        basename, format = base.split('.', 1)
+    except ValueError:
+        format = None
+        basename = base
+    return (basename, format, ext)
+
 def _generate_uuid():
     """Return a version 4 uuid string."""
     return str(uuid.uuid4())
@@ -558,9 +1351,12 @@ def _generate_uuid():
 def _make_tags(metadata, strip_nulls=False):
     """Make a tag file string out of a metadata dict."""
 
+    # Private attributes (e.g. the bag root handle) are not metadata
+    keys = [t for t in metadata.keys() if not t.startswith('_')]
+
     # Use "TERMS" to sort the metadata, then list everything else
-    headers = [t for t in metadata.keys() if t.lower() in TERMS]
-    headers.extend([t for t in sorted(metadata.keys())
+    headers = [t for t in keys if t.lower() in TERMS]
+    headers.extend([t for t in sorted(keys)
                         if not t in headers])
     #headers = sorted(metadata.keys())
     tags = list()
@@ -586,24 +1382,283 @@ def _make_tags(metadata, strip_nulls=False):
             tags.append('\r\n'.join(lines))
     return '\r\n'.join(tags)
 
-def _load_tag_file(tag_file_name):
-    """Parse a BagIt tag file. Return a dict."""
+class TagCache:
+    """An in-memory LRU cache of parsed tag files, keyed by absolute path.
 
-    with open(tag_file_name, "r") as tag_file:
-        # Store duplicate tags as list of vals
-        # in order of parsing under the same key.
-        tags = {}
-        for name, value in _parse_tags(tag_file):
-            if value in ("None", "null"):
-                value = None
-            if name not in tags:
-                tags[name] = value
-                continue
-            if not isinstance(tags[name], list):
-                tags[name] = [tags[name], value]
-            else:
-                tags[name].append(value)
+    An entry is only returned while the size and modification time of the
+    tag file match those recorded when it was parsed, so files edited by
+    hand or by another process are re-read. Each lookup returns a fresh copy
+    of the tags, which the caller may modify.
+
+    :param maxsize: The maximum number of tag files to keep.
+
+        >>> import odea
+        >>> b = odea.test_bag()
+        >>> b.save()
+        >>> cache = odea.TagCache()
+        >>> cache.get('bag-info.txt') is None
+        True
+        >>> cache.set('bag-info.txt', {'title': 'My test bag'})
+        >>> cache.get('bag-info.txt')
+        {'title': 'My test bag'}
+        >>> b.title = 'Modified title'
+        >>> b.save()
+        >>> cache.get('bag-info.txt') is None
+        True
+
+    """
+
+    def __init__(self, maxsize=TAG_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tag_file, st=None):
+        """Return a copy of the cached tags for <tag_file>, or None if they
+        are missing or stale. <st> may be given to avoid another ``stat``."""
+
+        key = os.path.abspath(tag_file)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if st is None:
+            try:
+                st = os.stat(key)
+            except OSError:
+                self.discard(tag_file)
+                return None
+        stamp, tags = entry
+        if stamp != (st.st_size, st.st_mtime_ns):
+            self.discard(tag_file)
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return {k: list(v) if isinstance(v, list) else v
+                    for k, v in tags.items()}
+
+    def set(self, tag_file, tags, st=None):
+        """Cache <tags> as the parsed contents of <tag_file>."""
+
+        key = os.path.abspath(tag_file)
+        if st is None:
+            try:
+                st = os.stat(key)
+            except OSError:
+                return
+        tags = {k: list(v) if isinstance(v, list) else v
+                    for k, v in tags.items()}
+        with self._lock:
+            self._entries[key] = ((st.st_size, st.st_mtime_ns), tags)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, tag_file):
+        """Drop any cached tags for <tag_file>."""
+        with self._lock:
+            self._entries.pop(os.path.abspath(tag_file), None)
+
+    def clear(self):
+        """Drop all cached tags."""
+        with self._lock:
+            self._entries.clear()
+
+#: The process-wide :py:class:`TagCache` used by :py:func:`load_bag`,
+#: :py:func:`load_item`, and :py:func:`load_file`.
+tag_cache = TagCache()
+
+class TagSnapshot:
+    """A persistent snapshot of the parsed tag files of a bag, stored in
+    :py:data:`TAG_SNAPSHOT` as a single :py:mod:`marshal` blob.
+
+    The snapshot is read in full when it is opened, and entries are validated
+    against the size and modification time of their tag file when they are
+    looked up, as for :py:class:`TagCache`. The tag files remain the
+    authoritative record; the snapshot can be deleted at any time.
+
+        >>> import odea
+        >>> b = odea.test_bag()
+        >>> b.save()
+        >>> snapshot = odea.TagSnapshot()
+        >>> snapshot.set('bag-info.txt', {'title': 'My test bag'})
+        >>> snapshot.save()
+        >>> odea.TagSnapshot().get('bag-info.txt')
+        {'title': 'My test bag'}
+
+    """
+
+    #: Format version of the snapshot; older snapshots are ignored.
+    VERSION = 1
+
+    def __init__(self, root=None, filename=TAG_SNAPSHOT):
+
+        #: Path to the snapshot file.
+        self.filename = _path(root, filename)
+
+        self._root = root
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        try:
+            with open(self.filename, 'rb') as f:
+                data = marshal.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            logger.warning('Ignoring tag snapshot {}: {}'.format(
+                            self.filename, e))
+            return
+        if isinstance(data, dict) and data.get('version') == self.VERSION:
+            self._entries = data['entries']
+
+    def _key(self, tag_file):
+        return _relative(self._root, tag_file)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, tag_file, st=None):
+        """Return a copy of the tags recorded for <tag_file>, or None if they
+        are missing or stale."""
+
+        entry = self._entries.get(self._key(tag_file))
+        if entry is None:
+            return None
+        if st is None:
+            try:
+                st = os.stat(tag_file)
+            except OSError:
+                return None
+        stamp, tags = entry
+        if stamp != (st.st_size, st.st_mtime_ns):
+            return None
+        return {k: list(v) if isinstance(v, list) else v
+                    for k, v in tags.items()}
+
+    def set(self, tag_file, tags, st=None):
+        """Record a copy of <tags> as the parsed contents of <tag_file>."""
+
+        if st is None:
+            try:
+                st = os.stat(tag_file)
+            except OSError:
+                return
+        # the lists are copied too, so that changes the caller makes to them
+        # without saving are not written out under the tag file's stamp
+        entry = ((st.st_size, st.st_mtime_ns),
+                 {k: list(v) if isinstance(v, list) else v
+                  for k, v in tags.items()})
+        key = self._key(tag_file)
+        with self._lock:
+            if self._entries.get(key) != entry:
+                self._entries[key] = entry
+                self._dirty = True
+
+    def save(self):
+        """Write the snapshot to disk, if it has changed. Entries for tag
+        files that no longer exist are dropped."""
+
+        with self._lock:
+            if not self._dirty:
+                return
+            top = self._root.path if self._root is not None else os.getcwd()
+            entries = {k: v for k, v in self._entries.items()
+                        if os.path.exists(os.path.join(top, k))}
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'wb') as f:
+                marshal.dump({'version': self.VERSION, 'entries': entries}, f)
+            os.replace(tmp, self.filename)
+            self._entries = entries
+            self._dirty = False
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+def get_tag_snapshot(root=None):
+    """Return the shared :py:class:`TagSnapshot` for the bag at <root> (a
+    :py:class:`BagRoot`; defaults to the current directory), or None if
+    :py:data:`TAG_SNAPSHOT` is None."""
+
+    if TAG_SNAPSHOT is None:
+        return None
+    key = root.path if root is not None else os.getcwd()
+    with _snapshots_lock:
+        if key not in _snapshots:
+            _snapshots[key] = TagSnapshot(root or BagRoot(key))
+        return _snapshots[key]
+
+def save_tag_snapshots():
+    """Write every changed :py:class:`TagSnapshot` to disk."""
+
+    for snapshot in list(_snapshots.values()):
+        try:
+            snapshot.save()
+        except OSError as e:
+            logger.warning('Could not save tag snapshot {}: {}'.format(
+                            snapshot.filename, e))
+
+def _cached_tags(tag_file, snapshot=None, st=None):
+    """Return the parsed tags of <tag_file> from :py:data:`tag_cache` or
+    <snapshot> (a :py:class:`TagSnapshot`), or None if neither has a
+    current entry."""
+
+    tags = tag_cache.get(tag_file, st)
+    if tags is None and snapshot is not None:
+        tags = snapshot.get(tag_file, st)
+        if tags is not None:
+            tag_cache.set(tag_file, tags, st)
+    return tags
+
+def _cache_tags(tag_file, tags, snapshot=None, st=None):
+    """Record the parsed tags of <tag_file> in :py:data:`tag_cache` and
+    <snapshot>."""
+
+    tag_cache.set(tag_file, tags, st)
+    if snapshot is not None:
+        snapshot.set(tag_file, tags, st)
+
+def _load_tag_file(tag_file_name, snapshot=None):
+    """Parse a BagIt tag file. Return a dict.
+
+    Parsed tags are kept in :py:data:`tag_cache` and, if given, in
+    <snapshot> (a :py:class:`TagSnapshot`), so a tag file that has not
+    changed is only parsed once.
+    """
+
+    st = os.stat(tag_file_name)
+    tags = _cached_tags(tag_file_name, snapshot, st)
+    if tags is not None:
         return tags
+    tags = _parse_tag_file(tag_file_name)
+    _cache_tags(tag_file_name, tags, snapshot, st)
+    return tags
+
+def _parse_tag_file(tag_file_name):
+    """Parse a BagIt tag file from disk. Return a dict."""
+
+    with open(tag_file_name, "r") as tag_file:
+        return _tags_from_lines(tag_file)
+
+def _tags_from_lines(lines):
+    """Parse the lines of a tag file. Return a dict."""
+
+    # Store duplicate tags as list of vals
+    # in order of parsing under the same key.
+    tags = {}
+    for name, value in _parse_tags(lines):
+        if value in ("None", "null"):
+            value = None
+        if name not in tags:
+            tags[name] = value
+            continue
+        if not isinstance(tags[name], list):
+            tags[name] = [tags[name], value]
+        else:
+            tags[name].append(value)
+    return tags
 
 
 def _parse_tags(tag_file):
@@ -641,17 +1696,1221 @@ def _parse_tags(tag_file):
     if tag_name:
         yield (tag_name, tag_value.strip())
 
-class File:
+######## METADATA LOG ########
+
+class MetadataLog:
+    """A packed, append-only store for item and file metadata, kept in the
+    file :py:data:`METADATA_LOG` in the bag root.
+
+    Each line of the log is a JSON record ``{"key": ..., "tags": ...}``,
+    where ``key`` is the path, relative to the bag root, of the tag file the
+    record stands for (e.g. ``item_metadata/<uuid>.txt``) and ``tags`` is
+    its parsed contents, or null if it was deleted. The last record for a
+    key wins. Saving metadata appends a single line, and loading all the
+    metadata of a bag is a single sequential read, instead of one file
+    operation per tag file.
+
+    The log is read incrementally: records appended by other processes are
+    picked up on the next lookup. Superseded records are dropped by
+    :py:meth:`compact`, which runs automatically as the log grows (see
+    :py:data:`METADATA_LOG_COMPACT_RATIO`). :py:meth:`pack` moves the
+    existing tag files into the log, and :py:meth:`export` writes the
+    standard tag file layout back out.
+
+        >>> import odea
+        >>> b = odea.test_bag()
+        >>> i = odea.Item(identifier=odea.NIL_UUID, title='test item')
+        >>> i.save()
+        >>> log = odea.MetadataLog()
+        >>> log.pack(remove=True)
+        1
+        >>> os.path.exists(i.tag_file())
+        False
+        >>> odea.load_item(odea.NIL_UUID).title
+        'test item'
+        >>> log.export(remove=True)
+        1
+        >>> os.path.exists(i.tag_file())
+        True
+
+    """
+
+    def __init__(self, root=None, filename=METADATA_LOG):
+
+        #: Path to the log file.
+        self.filename = _path(root, filename)
+
+        self._root = root
+        self._lock = threading.RLock()
+        self._reset(None)
+
+    def _reset(self, ino):
+        self._entries = {}
+        self._records = 0
+        self._offset = 0
+        self._ino = ino
+
+    def _refresh(self):
+        """Read any records appended since the last read."""
+
+        with self._lock:
+            try:
+                st = os.stat(self.filename)
+            except FileNotFoundError:
+                self._reset(None)
+                return
+            if st.st_ino != self._ino or st.st_size < self._offset:
+                # new or compacted log
+                self._reset(st.st_ino)
+            if st.st_size == self._offset:
+                return
+            with open(self.filename, 'rb') as log:
+                log.seek(self._offset)
+                data = log.read()
+            # ignore a partial line still being written
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    key, tags = record['key'], record['tags']
+                except (ValueError, KeyError, TypeError):
+                    logger.warning('Skipping invalid record in {}'.format(
+                                    self.filename))
+                    continue
+                self._records += 1
+                if tags is None:
+                    self._entries.pop(key, None)
+                else:
+                    self._entries[key] = tags
+            self._offset += end
+
+    def get(self, tag_file):
+        """Return a copy of the tags recorded for <tag_file>, or None."""
+
+        self._refresh()
+        tags = self._entries.get(_relative(self._root, tag_file))
+        if tags is None:
+            return None
+        return {k: list(v) if isinstance(v, list) else v
+                    for k, v in tags.items()}
+
+    def keys(self, pattern='*'):
+        """Return the sorted keys (tag file paths relative to the bag root)
+        matching the glob <pattern>."""
+
+        self._refresh()
+        return sorted(k for k in self._entries if fnmatch(k, pattern))
+
+    def _append(self, records):
+        lines = ''.join(json.dumps({'key': k, 'tags': t}) + '\n'
+                        for k, t in records)
+        with self._lock:
+            with open(self.filename, 'a') as log:
+                log.write(lines)
+            self._refresh()
+            if (self._records >= 1000 and self._records >
+                    METADATA_LOG_COMPACT_RATIO * max(len(self._entries), 1)):
+                self.compact()
+
+    def append(self, tag_file, tags):
+        """Record <tags> as the contents of <tag_file>."""
+        self._append([(_relative(self._root, tag_file), tags)])
+
+    def remove(self, tag_file):
+        """Record that <tag_file> has been deleted."""
+        self._append([(_relative(self._root, tag_file), None)])
+
+    def compact(self):
+        """Rewrite the log with a single record for each current entry."""
+
+        with self._lock:
+            self._refresh()
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as log:
+                for key in sorted(self._entries):
+                    log.write(json.dumps(
+                        {'key': key, 'tags': self._entries[key]}) + '\n')
+            os.replace(tmp, self.filename)
+            self._refresh()
+
+    def pack(self, remove=False):
+        """Append every item and file tag file in the bag to the log. Return
+        the number of tag files packed.
+
+        :param remove: If True, the tag files are deleted once the log has
+                       been written.
+        """
+
+        tag_files = []
+        for d in (ITEM_METADATA_DIR, FILE_METADATA_DIR):
+            tag_files.extend(str(p) for p in
+                    pathlib.Path(_path(self._root, d)).glob('*.txt'))
+        self._append([(_relative(self._root, fn), _parse_tag_file(fn))
+                        for fn in tag_files])
+        if remove:
+            for fn in tag_files:
+                os.remove(fn)
+                tag_cache.discard(fn)
+        return len(tag_files)
+
+    def export(self, remove=False):
+        """Write every entry in the log out as a tag file. Return the number
+        of tag files written.
+
+        :param remove: If True, the log is deleted once the tag files have
+                       been written, so the bag returns to the standard
+                       layout.
+        """
+
+        with self._lock:
+            self._refresh()
+            for key, tags in self._entries.items():
+                tag_file = _path(self._root, key)
+                with open(tag_file, 'w') as out:
+                    out.write(_make_tags(tags))
+                tag_cache.discard(tag_file)
+            count = len(self._entries)
+            if remove:
+                os.remove(self.filename)
+                _metadata_logs.pop(self.filename, None)
+            return count
+
+_metadata_logs = {}
+_metadata_logs_lock = threading.Lock()
+
+def get_metadata_log(root=None):
+    """Return the shared :py:class:`MetadataLog` of the bag at <root> (a
+    :py:class:`BagRoot`; defaults to the current directory), or None if the
+    bag does not use one."""
+
+    filename = os.path.abspath(_path(root, METADATA_LOG))
+    if not os.path.isfile(filename):
+        return None
+    with _metadata_logs_lock:
+        if filename not in _metadata_logs:
+            _metadata_logs[filename] = MetadataLog(root)
+        return _metadata_logs[filename]
+
+def _relative(root, path):
+    """Return <path> relative to the bag root (or the current directory if
+    <root> is None)."""
+    if root is None:
+        return os.path.relpath(path)
+    return root.relative(path)
+
+def _read_tags(tag_file, root=None):
+    """Return the parsed tags of an item or file tag file from the bag's
+    :py:class:`MetadataLog` or from disk, or None if there are none."""
+
+    log = get_metadata_log(root)
+    if log is not None:
+        tags = log.get(tag_file)
+        if tags is not None:
+            return tags
+    if not os.path.exists(tag_file):
+        return None
+    return _load_tag_file(tag_file, get_tag_snapshot(root))
+
+def _save_tags(tag_file, metadata, root=None):
+    """Save the tag file string <metadata> as <tag_file>, or append it to
+    the bag's :py:class:`MetadataLog` if it has one. Return the parsed tags
+    and the modification time of the tag file (None for the log)."""
+
+    log = get_metadata_log(root)
+    if log is not None:
+        tags = _tags_from_lines(metadata.splitlines(True))
+        log.append(tag_file, tags)
+        # the log is authoritative; don't leave an outdated copy behind
+        if os.path.exists(tag_file):
+            os.remove(tag_file)
+        tag_cache.discard(tag_file)
+        return tags, None
+
+    with open(tag_file, 'w') as out:
+        out.write(metadata)
+    # the mtime may not change if the file is rewritten quickly
+    tag_cache.discard(tag_file)
+    return _load_tag_file(tag_file), _tag_mtime(tag_file)
+
+def _tag_file_names(root, directory, pattern='*.txt'):
+    """Return the sorted paths of the tag files in <directory> matching
+    <pattern>, whether on disk or in the bag's :py:class:`MetadataLog`."""
+
+    names = set(str(p) for p in
+                pathlib.Path(_path(root, directory)).glob(pattern))
+    log = get_metadata_log(root)
+    if log is not None:
+        names.update(_path(root, key) for key in
+                     log.keys(os.path.join(directory, pattern)))
+    return sorted(names)
+
+######## HASH CACHE ########
+
+_dbm_locks = {}
+_dbm_locks_lock = threading.Lock()
+
+class _DbmFile:
+    """Base class for the dbm stores in :py:data:`CACHE_DIR`.
+
+    A dbm file can only be opened once at a time, so threads in the same
+    process take turns through a lock held for as long as the store is open.
+    """
+
+    def __init__(self, root, filename):
+
+        #: Path to the database.
+        self.filename = _path(root, filename)
+
+        self._root = root
+        path = os.path.abspath(self.filename)
+        with _dbm_locks_lock:
+            self._lock = _dbm_locks.setdefault(path, threading.RLock())
+        self._lock.acquire()
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            import dbm
+            self._db = dbm.open(self.filename, 'c')
+        except:
+            self._lock.release()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Write the database to disk and close it."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            self._lock.release()
+
+class HashCache(_DbmFile):
+    """A persistent cache of file digests, stored in :py:data:`HASH_CACHE`.
+
+    :param root: The :py:class:`BagRoot` of the bag. Defaults to the current
+                 directory.
+
+    Entries are keyed by filename (relative to the bag root) and record the
+    size, modification time (in nanoseconds), and inode of the file at the
+    time it was hashed. A cached digest is only returned while all three still
+    match the file on disk, so any change to the file invalidates the entry.
+
+        >>> import odea, os
+        >>> b = odea.test_bag()
+        >>> spam = os.path.join('data', 'spam.txt')
+        >>> with open(spam, 'w') as out:
+        ...     out.write('spam')
+        4
+        >>> with odea.HashCache() as cache:
+        ...     cache.set(spam, 'sha512', 'abc')
+        ...     cache.get(spam, 'sha512')
+        'abc'
+
+    Modifying the file invalidates the cached digest:
+
+        >>> with open(spam, 'a') as out:
+        ...     out.write(' and eggs')
+        9
+        >>> with odea.HashCache() as cache:
+        ...     cache.get(spam, 'sha512') == None
+        True
+
+    """
+
+    def __init__(self, root=None, filename=HASH_CACHE):
+        super().__init__(root, filename)
+
+    def _entry(self, filename):
+        try:
+            return json.loads(self._db[filename])
+        except (KeyError, ValueError):
+            return {}
+
+    def move(self, src, dst):
+        """Move the cache entry for a file that has been renamed on disk."""
+        try:
+            self._db[dst] = self._db[src]
+            del self._db[src]
+        except KeyError:
+            pass
+
+    def size(self, filename):
+        """Return the size the file had when it was last hashed, or None if it
+        is not in the cache."""
+        stat = self._entry(filename).get('stat')
+        if stat is None:
+            return None
+        return stat[0]
+
+    def get(self, filename, alg, st=None):
+        """Return the cached digest for a file, or None if the file has changed
+        since it was hashed.
+
+        :param st: An ``os.stat`` result for the file, if already available.
+        """
+
+        if st is None:
+            st = os.stat(_path(self._root, filename))
+        entry = self._entry(filename)
+        if entry.get('stat') != _stat_key(st):
+            return None
+        return entry.get(alg)
+
+    def set(self, filename, alg, digest, st=None):
+        """Record the digest of a file.
+
+        :param st: The ``os.stat`` result for the file, taken *before* it was
+                   hashed, so that a file modified during hashing will not be
+                   considered fresh.
+        """
+
+        if st is None:
+            st = os.stat(_path(self._root, filename))
+        key = _stat_key(st)
+        entry = self._entry(filename)
+        if entry.get('stat') != key:
+            entry = {'stat': key}
+        entry[alg] = digest
+        self._db[filename] = json.dumps(entry)
+
+class SourceIndex(_DbmFile):
+    """An index of source files in the bag by content, stored in
+    :py:data:`SRC_INDEX`. This maps the sha256 digest of every "SRC" file to
+    its item identifier and filename, so that a duplicate can be detected with
+    a single lookup at ingest.
+
+    :param root: The :py:class:`BagRoot` of the bag. Defaults to the current
+                 directory.
+
+    The index is built from the tag files in :py:data:`FILE_METADATA_DIR` the
+    first time it is opened, and kept up to date by :py:meth:`File.save`.
+    """
+
+    _COMPLETE = '__complete__'
+
+    def __init__(self, root=None, filename=SRC_INDEX):
+        super().__init__(root, filename)
+        if self._COMPLETE not in self._db:
+            self.rebuild()
+
+    def rebuild(self):
+        """Rebuild the index from the source file tag files."""
+        for key in list(self._db.keys()):
+            del self._db[key]
+        for tag_file in _tag_file_names(self._root, FILE_METADATA_DIR,
+                                        '*.SRC.txt'):
+            tags = _read_tags(tag_file, self._root) or {}
+            if tags.get('sha256') and tags.get('filename'):
+                self.add(tags['sha256'], tags.get('identifier'),
+                         tags['filename'])
+        self._db[self._COMPLETE] = '1'
+
+    def add(self, sha256, identifier, filename):
+        """Record a source file."""
+        self._db[sha256] = json.dumps([identifier, filename])
+
+    def lookup(self, sha256):
+        """Return the ``(identifier, filename)`` of the source file with the
+        given sha256 digest, or None.
+
+        Entries for files that no longer exist, or whose cached digest shows
+        that they have since changed, are discarded.
+        """
+        try:
+            identifier, filename = json.loads(self._db[sha256])
+        except (KeyError, ValueError):
+            return None
+        if not os.path.isfile(_path(self._root, filename)):
+            del self._db[sha256]
+            return None
+        with HashCache(self._root) as cache:
+            current = cache.get(filename, 'sha256')
+        if current is not None and current != sha256:
+            del self._db[sha256]
+            return None
+        return (identifier, filename)
+
+class DerivationIndex(_DbmFile):
+    """The provenance of every derivative in the bag, stored in
+    :py:data:`DERIVATION_INDEX`. For each derivative (keyed by filename) this
+    records the filename and sha256 digest of the file it was derived from,
+    and a digest of the command used (see :py:func:`_command_digest`).
+
+    :param root: The :py:class:`BagRoot` of the bag. Defaults to the current
+                 directory.
+
+        >>> import odea
+        >>> b = odea.test_bag()
+        >>> with odea.DerivationIndex() as index:
+        ...     index.set('data/deriv/a.df-mp3.x.mp3', 'data/a.SRC.x.wav',
+        ...               'abc', 'def')
+        ...     index.get('data/deriv/a.df-mp3.x.mp3')['sha256']
+        'abc'
+
+    """
+
+    def __init__(self, root=None, filename=DERIVATION_INDEX):
+        super().__init__(root, filename)
+
+    def get(self, filename):
+        """Return a dict with the ``source``, ``sha256``, and ``command`` a
+        derivative was generated from, or None if it is not recorded."""
+        try:
+            return json.loads(self._db[filename])
+        except (KeyError, ValueError):
+            return None
+
+    def set(self, filename, source, sha256, command):
+        """Record the provenance of a derivative."""
+        self._db[filename] = json.dumps(
+                {'source': source, 'sha256': sha256, 'command': command})
+
+def _file_digest(filename, alg='sha256', root=None):
+    """Return the digest of a file, from the :py:class:`HashCache` if it has
+    not changed since it was last hashed. Return None if the file does not
+    exist."""
+
+    import dbm
+    try:
+        st = os.stat(_path(root, filename))
+    except OSError:
+        return None
+    try:
+        with HashCache(root) as cache:
+            digest = cache.get(filename, alg, st)
+    except dbm.error:
+        digest = None
+    if digest is None and os.path.isfile(_path(root, filename)):
+        digest = _get_hash(_path(root, filename), alg)
+        try:
+            with HashCache(root) as cache:
+                cache.set(filename, alg, digest, st)
+        except dbm.error:
+            pass
+    return digest
+
+def _link_or_copy(src, dst):
+    """Replace <dst> with a hard link to <src>, or a copy of it if the file
+    system does not allow the link."""
+    # renaming over another link to the same file would do nothing
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp = dst + '.odea-link'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+class DerivativeCache:
+    """A content-addressed store of derivatives, in
+    :py:data:`DERIVATIVE_CACHE`.
+
+    :param root: The :py:class:`BagRoot` of the bag. Defaults to the current
+                 directory.
+
+    Each derivative generated by :py:meth:`File.derive` is hard-linked into
+    the cache under a key computed from the sha256 digest of its input, the
+    target and extension, and the command (see :py:meth:`key`). A later
+    derivation with the same key (e.g. after the source file is renamed, or
+    the same content is imported again) links the cached file instead of
+    running the command. Since the entries are hard links, they take no
+    additional space while the derivative remains in the bag.
+
+        >>> import odea, os
+        >>> b = odea.test_bag()
+        >>> with open('data/deriv/spam.mp3', 'w') as out:
+        ...     out.write('spam')
+        4
+        >>> cache = odea.DerivativeCache()
+        >>> key = cache.key('abc', 'DF_MP3', 'mp3', 'def')
+        >>> cache.add(key, 'data/deriv/spam.mp3')
+        >>> cache.fetch(key, 'data/deriv/eggs.mp3')
+        True
+        >>> os.path.samefile('data/deriv/spam.mp3', 'data/deriv/eggs.mp3')
+        True
+
+    """
+
+    def __init__(self, root=None, directory=None):
+        self._root = root
+
+        #: Path to the cache directory.
+        self.directory = _path(root, directory or DERIVATIVE_CACHE)
+
+    @staticmethod
+    def key(source_sha256, target, ext, command):
+        """Return the cache key of a derivative. <command> is the digest of
+        the command template and frame (:py:func:`_command_digest`)."""
+        key = '\0'.join([source_sha256, target.lower().replace('_', '-'),
+                         ext, command])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, key, filename):
+        """Link the cached derivative with <key> to <filename> (relative to
+        the bag root). Return True if it was found."""
+        entry = self._entry(key)
+        if not os.path.isfile(entry):
+            return False
+        try:
+            os.makedirs(os.path.dirname(_path(self._root, filename)),
+                        exist_ok=True)
+            _link_or_copy(entry, _path(self._root, filename))
+        except OSError as e:
+            logger.warning('Could not reuse cached {}: {}'.format(filename, e))
+            return False
+        return True
+
+    def add(self, key, filename):
+        """Add a derivative (relative to the bag root) to the cache.
+        Directories are not cached."""
+        path = _path(self._root, filename)
+        if not os.path.isfile(path):
+            return
+        entry = self._entry(key)
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            _link_or_copy(path, entry)
+        except OSError as e:
+            logger.warning('Could not cache {}: {}'.format(filename, e))
+
+    def prune(self):
+        """Remove the cached derivatives that are no longer linked from the
+        bag. Return the number removed."""
+        count = 0
+        if not os.path.isdir(self.directory):
+            return count
+        for entry in _scandir(self.directory):
+            if entry.stat().st_nlink == 1:
+                os.unlink(entry.path)
+                count += 1
+        return count
+
+def _command_digest(cmd_str, frame=None):
+    """Return a short digest identifying a derivation command template and
+    frame, so that changing either makes existing derivatives stale. The frame
+    is only part of the digest if the command uses it.
+
+        >>> import odea
+        >>> cmd = odea.CONVERTERS['DF_H264']
+        >>> odea._command_digest(cmd, 30) == odea._command_digest(cmd)
+        True
+        >>> cmd = odea.CONVERTERS['DF_IMG_STILL']
+        >>> odea._command_digest(cmd, 30) == odea._command_digest(cmd)
+        False
+
+    """
+    if '{frame}' not in str(cmd_str):
+        frame = None
+    key = '{}\0{}'.format(str(cmd_str), frame or 0)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+######## SCANNER ########
+
+def _scandir(top):
+    """Yield an ``os.DirEntry`` for every file below <top>, walking the tree
+    once with ``os.scandir``."""
+
+    stack = [top]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError as e:
+            logger.error('Could not scan {}: {}'.format(d, e))
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+class BagScan:
+    """A snapshot of the payload files in the bag, taken by walking
+    :py:data:`DATA_DIR` once.
+
+    Every filename is parsed according to the rules of
+    :py:meth:`File.get_filename_parts`, and tagged files are grouped by item
+    identifier, so that the files of any item can be listed without
+    searching the tree again.
+
+        >>> import odea, os
+        >>> b = odea.test_bag()
+        >>> id = '48342ee3-9080-407e-9862-12ce05143499'
+        >>> for fn in ['spam.SRC.{}.txt', 'deriv/spam.df-pdf.{}.pdf', 'eggs.txt']:
+        ...     open(os.path.join('data', fn.format(id)), 'w').close()
+        >>> scan = odea.BagScan()
+        >>> len(scan.filenames)
+        3
+        >>> scan.src(id)
+        'data/spam.SRC.48342ee3-9080-407e-9862-12ce05143499.txt'
+        >>> scan.files(id, format='df-pdf')
+        ['data/deriv/spam.df-pdf.48342ee3-9080-407e-9862-12ce05143499.pdf']
+
+    """
+
+    def __init__(self, root=None, top=DATA_DIR):
+
+        #: Sorted list of all files found, relative to the bag root.
+        self.filenames = []
+
+        #: Map of item identifier to a list of (filename, format, ext) tuples
+        #: for the tagged files of the item, sorted by filename.
+        self.by_identifier = {}
+
+        strip = len(root.path) + 1 if root is not None else 0
+        for entry in _scandir(_path(root, top)):
+            fn = entry.path[strip:]
+            self.filenames.append(fn)
+            ids = re.findall(RE_UUID, entry.name)
+            if not ids:
+                continue
+            identifier = ids[-1]
+            basename, format, ext = _filename_parts(fn, identifier)
+            self.by_identifier.setdefault(identifier, []).append(
+                    (fn, format, ext))
+        self.filenames.sort()
+        for files in self.by_identifier.values():
+            files.sort()
+
+    def files(self, identifier, format=None):
+        """Return the sorted filenames of the files of an item, optionally
+        restricted to one format."""
+        return [fn for fn, fmt, ext in self.by_identifier.get(identifier, [])
+                if format is None or fmt == format]
+
+    def src(self, identifier):
+        """Return the filename of the source file of an item, or None."""
+        src = self.files(identifier, format='SRC')
+        return src[0] if src else None
+
+_active_scans = {}
+
+@contextlib.contextmanager
+def bag_scan(root=None):
+    """Walk the bag once and share the resulting :py:class:`BagScan` with
+    all bag-wide operations on the same bag run inside the ``with`` block,
+    e.g. :py:meth:`Item.files` and :py:meth:`Item.src`. Nested calls share
+    the outermost scan.
+
+    The scan is a snapshot: files created inside the block are not seen.
+    """
+
+    if root in _active_scans:
+        yield _active_scans[root]
+        return
+    _active_scans[root] = scan = BagScan(root)
+    try:
+        yield scan
+    finally:
+        _active_scans.pop(root, None)
+
+######## CATALOG ########
+
+class Catalog:
+    """An on-disk SQLite index of the items and files in the bag, stored in
+    :py:data:`CATALOG`.
+
+    The tag files remain the source of truth. Each catalog row keeps a copy of
+    the parsed tags along with the modification time of the tag file it was
+    read from, so :py:func:`load_item` and :py:func:`load_file` only need to
+    ``stat`` the tag file rather than parse it, and :py:meth:`Item.files` and
+    :py:meth:`Item.src` become indexed queries instead of globs over the
+    whole bag.
+
+        >>> import odea, os
+        >>> b = odea.test_bag()
+        >>> id = '48342ee3-9080-407e-9862-12ce05143499'
+        >>> i = odea.Item(identifier=id, title='test item')
+        >>> i.save()
+        >>> spam = os.path.join('data', 'spam.SRC.{}.txt'.format(id))
+        >>> open(spam, 'w').close()
+        >>> with odea.Catalog() as c:
+        ...     c.rebuild()
+        ...     c.item_files(id, format='SRC')
+        ['data/spam.SRC.48342ee3-9080-407e-9862-12ce05143499.txt']
+
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS items (
+            identifier TEXT PRIMARY KEY,
+            title TEXT,
+            dcmi_type TEXT,
+            tags TEXT,
+            tag_mtime INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            filename TEXT PRIMARY KEY,
+            identifier TEXT,
+            format TEXT,
+            ext TEXT,
+            size INTEGER,
+            mtime TEXT,
+            sha256 TEXT,
+            thumb TEXT,
+            preview TEXT,
+            tags TEXT,
+            tag_mtime INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS files_identifier
+            ON files (identifier, format);
+        CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+    """
+
+    def __init__(self, root=None, filename=CATALOG):
+
+        #: Path to the catalog database.
+        self.filename = _path(root, filename)
+
+        self._root = root
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        # the connection is shared by all threads, one statement at a time
+        import sqlite3
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._db.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Commit any changes and close the catalog."""
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+    def rebuild(self):
+        """Rebuild the catalog from the item tag files and from a single walk
+        of the payload directory (see :py:class:`BagScan`)."""
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM items')
+            self._db.execute('DELETE FROM files')
+            for tag_file in _tag_file_names(self._root, ITEM_METADATA_DIR):
+                identifier = pathlib.Path(tag_file).stem
+                self.update_item(identifier, _read_tags(tag_file, self._root),
+                        _tag_mtime(tag_file), commit=False)
+            with bag_scan(self._root) as scan:
+                for identifier, files in scan.by_identifier.items():
+                    for filename, format, ext in files:
+                        f = File(filename, identifier=identifier,
+                                format=format, root=self._root)
+                        tag_file = f.tag_file()
+                        tags = None
+                        if tag_file:
+                            tags = _read_tags(tag_file, self._root)
+                        self.update_file(filename, identifier, format, ext,
+                                tags, _tag_mtime(tag_file), commit=False)
+
+    def update_item(self, identifier, tags, tag_mtime, commit=True):
+        """Record the parsed tags of an item tag file."""
+        self._execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)',
+                (identifier, _first(tags.get('title')),
+                 _first(tags.get('dcmi_type')), json.dumps(tags), tag_mtime),
+                commit)
+
+    def update_file(self, filename, identifier, format, ext, tags, tag_mtime,
+            commit=True):
+        """Record a payload file and the parsed tags of its tag file."""
+        t = tags or {}
+        self._execute('INSERT OR REPLACE INTO files VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (filename, identifier, format, ext, _first(t.get('size')),
+                 _first(t.get('mtime')), _first(t.get('sha256')),
+                 _first(t.get('thumb')), _first(t.get('preview')),
+                 json.dumps(tags) if tags is not None else None, tag_mtime),
+                commit)
+
+    def remove_file(self, filename):
+        """Remove a file that no longer exists from the catalog."""
+        self._execute('DELETE FROM files WHERE filename = ?', (filename,))
+
+    def _execute(self, sql, args=(), commit=True):
+        """Run a statement, holding the lock. Return the fetched rows."""
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+            if commit:
+                self._db.commit()
+            return rows
+
+    def item_tags(self, identifier, tag_mtime):
+        """Return the cached tags of an item, or None if the tag file has been
+        modified (or the item is unknown)."""
+        rows = self._execute('SELECT tags, tag_mtime FROM items '
+                'WHERE identifier = ?', (identifier,), commit=False)
+        if not rows or rows[0][1] != tag_mtime:
+            return None
+        return json.loads(rows[0][0])
+
+    def file_tags(self, filename, tag_mtime):
+        """Return the cached tags of a file, or None if its tag file has been
+        modified (or the file is unknown)."""
+        rows = self._execute('SELECT tags, tag_mtime FROM files '
+                'WHERE filename = ?', (filename,), commit=False)
+        if not rows or rows[0][0] is None or rows[0][1] != tag_mtime:
+            return None
+        return json.loads(rows[0][0])
+
+    def items(self):
+        """Return the sorted identifiers of all catalogued items."""
+        rows = self._execute('SELECT identifier FROM items '
+                'ORDER BY identifier', commit=False)
+        return [row[0] for row in rows]
+
+    def files(self):
+        """Return a list of ``(filename, identifier, format, size, mtime,
+        sha256, thumb)`` tuples for every catalogued file, sorted by
+        filename."""
+        return self._execute('SELECT filename, identifier, format, size, '
+                'mtime, sha256, thumb FROM files ORDER BY filename',
+                commit=False)
+
+    def item_files(self, identifier, format=None):
+        """Return the sorted filenames of the payload files of an item,
+        optionally restricted to one format."""
+        sql = 'SELECT filename FROM files WHERE identifier = ?'
+        args = [identifier]
+        if format is not None:
+            sql += ' AND format = ?'
+            args.append(format)
+        rows = self._execute(sql + ' ORDER BY filename', args, commit=False)
+        return [row[0] for row in rows]
+
+_catalogs = {}
+
+def get_catalog(root=None):
+    """Return the shared :py:class:`Catalog` for the bag at <root> (a
+    :py:class:`BagRoot`; defaults to the current directory), or None if the
+    bag has no catalog."""
+
+    key = root.path if root is not None else os.getcwd()
+    if key not in _catalogs:
+        if not os.path.isfile(os.path.join(key, CATALOG)):
+            return None
+        _catalogs.setdefault(key, Catalog(root or BagRoot(key)))
+    return _catalogs[key]
+
+def _existing(catalog, filenames, root=None):
+    """Filter a list of catalogued filenames to those still on disk, dropping
+    the others from the catalog."""
+    out = []
+    for fn in filenames:
+        if os.path.isfile(_path(root, fn)):
+            out.append(fn)
+        else:
+            catalog.remove_file(fn)
+    return out
+
+def _first(value):
+    """Return the first value of a repeated tag."""
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+def _tag_mtime(tag_file):
+    """Return the mtime of a tag file in nanoseconds, or None."""
+    try:
+        return os.stat(tag_file).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+######## FILE TABLE ########
+
+# The fields of an os.stat result used by the HashCache
+_TableStat = collections.namedtuple('_TableStat', 'st_size st_mtime_ns st_ino')
+
+class FileTable:
+    """A compact, column-oriented table of the payload files in the bag, for
+    operations over every file (manifests, verification, index pages, size
+    reports) that only need a few properties of each, rather than a
+    :py:class:`File` object with a parsed tag file.
+
+    Sizes, modification times, and inode numbers are stored in
+    :py:mod:`array` buffers. Identifiers and formats, which repeat across
+    the files of an item, are stored as integer codes into the shared list
+    :py:attr:`values`. An unknown number is recorded as -1 (0 for inodes),
+    and an unknown code as -1.
+
+    Build a table with :py:meth:`from_scan`, which walks and stats the
+    payload directory once, or :py:meth:`from_catalog`, which reads the
+    :py:class:`Catalog` without touching the files.
+
+        >>> import odea, os
+        >>> b = odea.test_bag()
+        >>> id = '48342ee3-9080-407e-9862-12ce05143499'
+        >>> for fn in ['spam.SRC.{}.txt', 'deriv/spam.df-pdf.{}.pdf']:
+        ...     with open(os.path.join('data', fn.format(id)), 'w') as f:
+        ...         f.write('spam')
+        4
+        4
+        >>> t = odea.FileTable.from_scan()
+        >>> len(t)
+        2
+        >>> t.select(identifier=id, format='SRC')
+        [1]
+        >>> t.filenames[1]
+        'data/spam.SRC.48342ee3-9080-407e-9862-12ce05143499.txt'
+        >>> t.summary()
+        {'SRC': (1, 4), 'df-pdf': (1, 4)}
+
+    """
+
+    def __init__(self):
+
+        #: Filenames, relative to the bag root.
+        self.filenames = []
+
+        #: Item identifier of each file, as a code into :py:attr:`values`.
+        self.identifiers = array.array('i')
+
+        #: Format of each file, as a code into :py:attr:`values`.
+        self.formats = array.array('i')
+
+        #: Size of each file in bytes.
+        self.sizes = array.array('q')
+
+        #: Modification time of each file, in nanoseconds since the epoch.
+        self.mtimes = array.array('q')
+
+        #: Inode number of each file.
+        self.inodes = array.array('Q')
+
+        #: sha256 digest of each file, or None.
+        self.sha256 = []
+
+        #: Thumbnail image of each file, or None.
+        self.thumbs = []
+
+        #: The identifiers and formats referred to by the codes.
+        self.values = []
+
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def _code(self, value):
+        if value is None:
+            return -1
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(sys.intern(value))
+        return code
+
+    def append(self, filename, identifier=None, format=None, size=-1,
+            mtime=-1, inode=0, sha256=None, thumb=None):
+        """Add a row to the table."""
+        self.filenames.append(filename)
+        self.identifiers.append(self._code(identifier))
+        self.formats.append(self._code(format))
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.inodes.append(inode)
+        self.sha256.append(sha256)
+        self.thumbs.append(thumb)
+
+    def identifier(self, i):
+        """Return the item identifier of row <i>, or None."""
+        code = self.identifiers[i]
+        return self.values[code] if code >= 0 else None
+
+    def format(self, i):
+        """Return the format of row <i>, or None."""
+        code = self.formats[i]
+        return self.values[code] if code >= 0 else None
+
+    def stat(self, i):
+        """Return the size, modification time, and inode of row <i> in the
+        form of an ``os.stat`` result, as used by the
+        :py:class:`HashCache`."""
+        return _TableStat(self.sizes[i], self.mtimes[i], self.inodes[i])
+
+    def select(self, identifier=None, format=None):
+        """Return the row numbers of the files with the given identifier
+        and/or format."""
+        rows = range(len(self))
+        if identifier is not None:
+            code = self._codes.get(identifier)
+            rows = [i for i in rows if self.identifiers[i] == code]
+        if format is not None:
+            code = self._codes.get(format)
+            rows = [i for i in rows if self.formats[i] == code]
+        return list(rows)
+
+    def total_size(self):
+        """Return the total size of the files of known size, in bytes."""
+        return sum(size for size in self.sizes if size > 0)
+
+    def summary(self):
+        """Return a dict of {format: (number of files, total size)}, sorted
+        by format. Files without a format are counted under None."""
+        counts = {}
+        for code, size in zip(self.formats, self.sizes):
+            n, total = counts.get(code, (0, 0))
+            counts[code] = (n + 1, total + max(size, 0))
+        return {(self.values[c] if c >= 0 else None): counts[c]
+                for c in sorted(counts,
+                    key=lambda c: self.values[c] if c >= 0 else '')}
+
+    @classmethod
+    def from_scan(cls, root=None, top=DATA_DIR):
+        """Build a table from a single walk of the payload directory (see
+        :py:class:`BagScan`), with the size, modification time, and inode
+        of every file."""
+
+        table = cls()
+        strip = len(root.path) + 1 if root is not None else 0
+        for entry in sorted(_scandir(_path(root, top)), key=lambda e: e.path):
+            fn = entry.path[strip:]
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            identifier = format = None
+            ids = re.findall(RE_UUID, entry.name)
+            if ids:
+                identifier = ids[-1]
+                basename, format, ext = _filename_parts(fn, identifier)
+            table.append(fn, identifier, format, st.st_size, st.st_mtime_ns,
+                         st.st_ino)
+        return table
+
+    @classmethod
+    def from_catalog(cls, catalog):
+        """Build a table from the files recorded in a :py:class:`Catalog`,
+        with the sizes, modification times, digests, and thumbnails taken
+        from their tag files. Inode numbers are not known."""
+
+        table = cls()
+        for filename, identifier, format, size, mtime, sha256, thumb in \
+                catalog.files():
+            try:
+                size = int(size)
+            except (TypeError, ValueError):
+                size = -1
+            try:
+                t = datetime.strptime(mtime, '%Y-%m-%dT%H:%M:%SZ')
+                mtime = int(t.timestamp()) * 10**9
+            except (TypeError, ValueError):
+                mtime = -1
+            table.append(filename, identifier, format, size, mtime, 0,
+                         sha256, thumb)
+        return table
+
+######## METADATA OBJECTS ########
+
+class _Metadata:
+    """Base class for :py:class:`File`, :py:class:`Item`, and :py:class:`Bag`.
+
+    The metadata elements known to each class (listed in ``_FIELDS``) are
+    stored in slots, so that tens of thousands of objects can be held in
+    memory at little cost. Any other tag read from a tag file is kept in a
+    separate dict of extras (created only when needed), and is read and
+    written as an attribute in the same way. A known element that has not
+    been set reads as None.
+    """
+
+    __slots__ = ('_root', '_extras')
+
+    #: Names of the metadata elements stored in slots, in order.
+    _FIELDS = ()
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        object.__setattr__(self, '_root', None)
+        object.__setattr__(self, '_extras', None)
+        return self
+
+    def __getattr__(self, name):
+        # only called if there is no slot value or class attribute
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._extras and name in self._extras:
+            return self._extras[name]
+        if name in self._FIELDS:
+            return None
+        raise AttributeError("{!r} object has no attribute {!r}".format(
+                                type(self).__name__, name))
+
+    def __setattr__(self, name, value):
+        if hasattr(type(self), name):
+            # a slot (or a property)
+            object.__setattr__(self, name, value)
+        elif self._extras is None:
+            object.__setattr__(self, '_extras', {name: value})
+        else:
+            self._extras[name] = value
+
+    def __delattr__(self, name):
+        if hasattr(type(self), name):
+            object.__delattr__(self, name)
+            return
+        try:
+            del self._extras[name]
+        except (KeyError, TypeError):
+            raise AttributeError(name) from None
+
+    def __str__(self):
+        return str(self._metadata())
+
+    def _metadata(self, strip_nulls=False):
+        """Return a dict of the metadata elements that have been set,
+        followed by the extras."""
+
+        m = {}
+        for name in self._FIELDS:
+            try:
+                value = object.__getattribute__(self, name)
+            except AttributeError:
+                continue
+            if not (strip_nulls and value is None):
+                m[name] = value
+        for name, value in (self._extras or {}).items():
+            if not (strip_nulls and value is None):
+                m[name] = value
+        return m
+
+    def _json(self, strip_nulls=False):
+        return json.dumps(self._metadata(strip_nulls), sort_keys=True,
+                          default=str)
+
+class File(_Metadata):
     """This is a file on disk."""
 
+    _FIELDS = ('filename', 'sha512', 'sha256', 'size', 'mtime', 'identifier',
+               'basename', 'format', 'ext', 'thumb', 'preview', 'dimensions',
+               'duration', 'original_name', 'duplicates')
+    __slots__ = _FIELDS
+
     def __init__(self, filename=None, sha512=None, sha256=None, size=None,
             mtime=None, identifier=None, basename=None, format=None, ext=None,
-            preview=None, dimensions=None, duration=None, thumb=None):
+            preview=None, dimensions=None, duration=None, thumb=None,
+            root=None):
 
         #: The filename, including relative directory path from the bag root
         #: (e.g., `data/subdir/file.ext`)
         self.filename = filename
 
+        # The BagRoot of the bag containing the file. If None, the filename
+        # is taken relative to the current working directory.
+        self._root = root
+
         #: The sha512 hash of the file (hex string)
         self.sha512 = sha512
 
@@ -709,20 +2968,78 @@ class File:
             sys.exit("Unable to enter bag root")
         os.chdir(root)
 
-    def __str__(self):
-        attrs = vars(self)
-        return str(attrs)
+    @property
+    def path(self):
+        """The path of the file on disk: absolute if the File was loaded with
+        a :py:class:`BagRoot`, otherwise relative to the current directory."""
+        return _path(self._root, self.filename)
 
     # use setters for the hashes so that we can include them as
     # properties in the object signature, to ensure they will be added
     # to the serialized output
 
+    def get_checksums(self, algs=None):
+        """Calculate several hashes of the file in a single read, and set the
+        corresponding properties (e.g., :py:attr:`sha256` and
+        :py:attr:`sha512`). Return a dict of {alg: hex digest}.
+
+        :param algs: A list of algorithms known to hashlib. Defaults to
+                     :py:data:`DEFAULT_CHECKSUMS`.
+
+        Digests are looked up in and saved to the :py:class:`HashCache`, so an
+        unchanged file is not read again when the manifest is updated.
+
+            >>> import odea
+            >>> b = odea.test_bag()
+            >>> f = odea.load_sample_file('test_plain-text.txt')
+            >>> f.get_checksums(['sha256', 'blake2b']) # doctest: +ELLIPSIS
+            {'sha256': '92b772380a3f8e27a93e57e6deeca6c01da07f5aadce78bb2fbb20de10a66925', 'blake2b': '...'}
+            >>> f.blake2b == f.get_checksums(['blake2b'])['blake2b']
+            True
+
+        """
+
+        if algs is None:
+            algs = DEFAULT_CHECKSUMS
+        if not os.path.isfile(self.path):
+            return None
+
+        import dbm
+        st = os.stat(self.path)
+        digests = {}
+        try:
+            with HashCache(self._root) as cache:
+                for alg in algs:
+                    c = cache.get(self.filename, alg, st)
+                    if c is not None:
+                        digests[alg] = c
+        except dbm.error as e:
+            logger.warning('Hash cache unavailable: {}'.format(e))
+
+        missing = [alg for alg in algs if alg not in digests]
+        if missing:
+            # the cache is not held open while hashing, so other threads
+            # can use it
+            computed = get_hash_engine().hash_file(self.path, missing)
+            digests.update(computed)
+            try:
+                with HashCache(self._root) as cache:
+                    for alg in missing:
+                        cache.set(self.filename, alg, computed[alg], st)
+            except dbm.error as e:
+                logger.warning('Hash cache unavailable: {}'.format(e))
+
+        for alg in algs:
+            setattr(self, alg, digests[alg])
+        return {alg: digests[alg] for alg in algs}
+
     def get_checksum(self, alg='sha512'):
         """Calculate the hash for a file.
 
         :param alg: Supported algorithms are "sha256" and "sha512".
 
-        .. seealso:: :py:meth:`get_sha256`, :py:meth:`get_sha512`.
+        .. seealso:: :py:meth:`get_sha256`, :py:meth:`get_sha512`,
+                     :py:meth:`get_checksums`.
 
         """
 
@@ -750,7 +3067,7 @@ class File:
 
         """
 
-        self.sha256 = _get_hash(self.filename, 'sha256')
+        self.sha256 = _get_hash(self.path, 'sha256')
         return self.sha256
 
     def get_sha512(self):
@@ -770,7 +3087,7 @@ class File:
 
         """
 
-        self.sha512 = _get_hash(self.filename, 'sha512')
+        self.sha512 = _get_hash(self.path, 'sha512')
         return self.sha512
 
     def json(self):
@@ -793,7 +3110,7 @@ class File:
             }
 
         """
-        return jsons.dumps(self, strip_nulls=True)
+        return self._json(strip_nulls=True)
 
     def get_mtime(self):
         """Return the mtime of a file on disk and set the :py:attr:`mtime`
@@ -816,9 +3133,9 @@ class File:
             '2012-03-02T12:18:12Z'
 
         """
-        if not os.path.isfile(self.filename):
+        if not os.path.isfile(self.path):
             return None
-        self.mtime = _isotime(os.stat(self.filename).st_mtime)
+        self.mtime = _isotime(os.stat(self.path).st_mtime)
         return self.mtime
 
     def get_img_dimensions(self):
@@ -838,8 +3155,9 @@ class File:
 
         """
 
+        from PIL import Image
         try:
-            im = Image.open(self.filename)
+            im = Image.open(self.path)
             width, height = im.size
         except:
             logging.error('Could not retrieve image dimensions')
@@ -868,7 +3186,7 @@ class File:
 
         try:
             import soundfile # not possible without binary soundlib
-            a = soundfile.SoundFile(self.filename)
+            a = soundfile.SoundFile(self.path)
         except:
             logging.error('Could not load sound file')
             return None
@@ -893,7 +3211,7 @@ class File:
         """
 
         from moviepy.editor import VideoFileClip
-        clip = VideoFileClip(self.filename)
+        clip = VideoFileClip(self.path)
         self.duration = clip.duration
         logger.info("Duration: {}".format(self.duration))
 
@@ -911,9 +3229,9 @@ class File:
             3506068
 
         """
-        if not os.path.isfile(self.filename):
+        if not os.path.isfile(self.path):
             return None
-        self.size = os.path.getsize(self.filename)
+        self.size = os.path.getsize(self.path)
         return self.size
 
     def get_uuid(self):
@@ -1035,6 +3353,7 @@ class File:
         extension).
         """
 
+        from slugify import slugify
         regex_pattern = r'[^-a-z0-9_/.]+'
         slug = slugify(self.basename, max_length=60, regex_pattern=regex_pattern)
         return slug
@@ -1072,13 +3391,107 @@ class File:
             logger.info("Filename unchanged: {}".format(fn))
             return self.filename
         try:
-            os.rename(self.filename, fn)
+            os.rename(self.path, _path(self._root, fn))
         except:
             logger.error("Error renaming {} -> {}".format(self.filename, fn))
             return self.filename
 
-        self.filename = fn
-        return self.filename
+        # keep cached digests, which are keyed by filename
+        import dbm
+        try:
+            with HashCache(self._root) as cache:
+                cache.move(self.filename, fn)
+        except dbm.error as e:
+            logger.warning('Hash cache unavailable: {}'.format(e))
+
+        self.filename = fn
+        return self.filename
+
+    def add_duplicate(self, filename, remove=False):
+        """Record <filename>, a file with the same contents as this one (see
+        :py:meth:`find_duplicate`), as another copy of it, and take it out of
+        the payload. The copy is moved to the directory named by the
+        :py:attr:`identifier` in :py:data:`DUPLICATES_DIR`, or deleted if
+        <remove> is True. Its original filename is added to the
+        ``duplicates`` metadata element, and the file metadata is saved. Return the new
+        filename of the copy, or None if it was deleted.
+
+            >>> import odea, os
+            >>> b = odea.test_bag()
+            >>> with open(os.path.join('data', 'eggs.txt'), 'w') as out:
+            ...     out.write('Spam, eggs, bacon, and spam!')
+            28
+            >>> f = odea.load_file(os.path.join('data', 'eggs.txt'))
+            >>> fn = f.tag()
+            >>> fn = f.rename()
+            >>> f.save()
+            >>> for fn in ('spam.txt', 'ham.txt'):
+            ...     with open(os.path.join('data', fn), 'w') as out:
+            ...         o = out.write('Spam, eggs, bacon, and spam!')
+            >>> moved = f.add_duplicate(os.path.join('data', 'spam.txt'))
+            >>> moved == os.path.join('duplicates', f.identifier, 'spam.txt')
+            True
+            >>> os.path.exists(os.path.join('data', 'spam.txt'))
+            False
+            >>> f.add_duplicate(os.path.join('data', 'ham.txt'), remove=True)
+            >>> odea.load_file(f.filename).duplicates
+            ['data/spam.txt', 'data/ham.txt']
+
+        """
+
+        moved_to = None
+        if remove:
+            os.remove(_path(self._root, filename))
+        else:
+            moved_to = os.path.join(DUPLICATES_DIR, self.identifier,
+                                    os.path.relpath(filename, DATA_DIR))
+            os.makedirs(os.path.dirname(_path(self._root, moved_to)),
+                        exist_ok=True)
+            # a copy already there has the same contents
+            os.replace(_path(self._root, filename),
+                       _path(self._root, moved_to))
+
+        # a single value is read back from the tag file as a string
+        duplicates = self.duplicates or []
+        if not isinstance(duplicates, list):
+            duplicates = [duplicates]
+        self.duplicates = duplicates + [filename]
+        self.save()
+        logger.info('{} duplicates {}; {}'.format(filename, self.filename,
+                    'moved to {}'.format(moved_to) if moved_to else 'removed'))
+        return moved_to
+
+    def find_duplicate(self):
+        """Return the filename of an existing source file in the bag with the
+        same contents, or None.
+
+        The lookup is a single query of the :py:class:`SourceIndex` by
+        :py:attr:`sha256`, which is calculated if it is not yet set. The file
+        itself is not reported as its own duplicate.
+
+            >>> import odea, os
+            >>> b = odea.test_bag()
+            >>> f = odea.load_sample_file('test_plain-text.txt')
+            >>> f.save()
+            >>> spam = os.path.join('data', 'spam.txt')
+            >>> o = shutil.copyfile(f.filename, spam)
+            >>> odea.load_file(spam).find_duplicate() == f.filename
+            True
+            >>> f.find_duplicate() == None
+            True
+
+        """
+
+        if not getattr(self, 'sha256', None):
+            self.get_checksums()
+        with SourceIndex(self._root) as index:
+            match = index.lookup(self.sha256)
+        if match is None:
+            return None
+        identifier, filename = match
+        if filename == self.filename or identifier == self.identifier:
+            return None
+        return filename
 
     def get_filename_parts(self):
         """Populate filename part properties from the filename itself.
@@ -1090,31 +3503,41 @@ class File:
         .. seealso:: :py:meth:`tag`
         """
 
-        if self.identifier and self.identifier in self.filename:
-            b, ext = self.filename.split(self.identifier)
-            base = b.strip('.')
-        else:
-            # we can have basename and format without UUID.
-            base, ext = os.path.splitext(self.filename)
-        self.ext = ext.strip('.')
+        self.basename, self.format, self.ext = _filename_parts(self.filename,
+                                                    self.identifier)
 
-        try:
-            self.basename, self.format = base.split('.', 1)
-        except ValueError:
-            self.format = None
-            self.basename = base
+    def tag_file(self):
+        """Return the path of the tag file for the File, or None if the file
+        has no identifier or format."""
+
+        if not self.identifier or not self.format:
+            return None
+        return _path(self._root, FILE_METADATA_DIR,
+            '{}.{}.txt'.format(self.identifier, self.format))
 
     def save(self):
         """Save the File data structure to disk.
         """
 
-        o = os.path.join(FILE_METADATA_DIR,
+        o = _path(self._root, FILE_METADATA_DIR,
             '{}.{}.txt'.format(self.identifier, self.format))
-        logger.info('Saving to {}'.format(os.getcwd()))
+        logger.info('Saving to {}'.format(o))
 
-        metadata = _make_tags(vars(self), strip_nulls=True)
-        with open(o, 'w') as out:
-            out.write(metadata)
+        metadata = _make_tags(self._metadata(), strip_nulls=True)
+        tags, tag_mtime = _save_tags(o, metadata, self._root)
+
+        catalog = get_catalog(self._root)
+        if catalog is not None and self.filename.startswith(DATA_DIR + os.sep):
+            catalog.update_file(self.filename, self.identifier, self.format,
+                    self.ext, tags, tag_mtime)
+
+        if self.format == 'SRC' and getattr(self, 'sha256', None):
+            import dbm
+            try:
+                with SourceIndex(self._root) as index:
+                    index.add(self.sha256, self.identifier, self.filename)
+            except dbm.error as e:
+                logger.warning('Source index unavailable: {}'.format(e))
 
 
     def derive(self, target, ext, frame=None, overwrite=False, target_dir=None):
@@ -1122,6 +3545,7 @@ class File:
         the derived file.
 
         :param target: Conversion target. Available targets are produced
+                       by the commands in :py:data:`CONVERTERS`, or else
                        through shell scripts defined in the variables
                        ``odea.CMD_<RULE>``, which can be overwritten or
                        extended. The built-in targets are listed below.
@@ -1305,43 +3729,102 @@ class File:
             '397x600'
 
         """
+        try:
+            return self._derive(target, ext, frame, overwrite, target_dir)
+        except DeriveTimeoutError as e:
+            logger.error(str(e))
+            return None
+
+    def _derive(self, target, ext, frame=None, overwrite=False,
+            target_dir=None):
+        """Generate a derivative as for :py:meth:`derive`, raising
+        :py:class:`DeriveTimeoutError` if the command runs out of time."""
+
         if not getattr(self, 'basename', None):
             logging.error('No basename is set for the input file.')
             return
 
-        if not target_dir:
-            target_dir = DERIV_DIR
         if not frame:
             frame = 0
 
-        basename = os.path.join(target_dir, os.path.basename(self.basename))
-        target_fn = "{}.{}.{}.{}".format(basename,
-                    target.lower().replace('_','-'), self.identifier, ext)
+        target_fn = self.derive_filename(target, ext, target_dir)
 
-        if overwrite is False and os.path.exists(target_fn):
+        if overwrite is False and os.path.exists(_path(self._root, target_fn)):
             return target_fn
 
-        cmd_str = globals()['CMD_' + target.upper().replace('-','_')]
+        cmd_str = _command_template(target)
         source=self.filename
 
-        cmd = cmd_str.format(
-            source=source,
-            target=target_fn,
-            frame=frame)
-
-        timeout = 30
-        if 'ffmpeg' in cmd:
-            timeout = 3600 # one hour for videos; the user can cancel manually
+        # taken before the command runs, as for the HashCache
+        source_sha256 = None
+        if os.path.isfile(self.path):
+            source_sha256 = _file_digest(source, 'sha256', self._root)
+        command = _command_digest(cmd_str, frame)
+
+        # reuse a derivative of the same content made by the same command
+        cache = key = None
+        if DERIVATIVE_CACHE and source_sha256:
+            cache = DerivativeCache(self._root)
+            key = cache.key(source_sha256, target, ext, command)
+            if cache.fetch(key, target_fn):
+                logger.info('Reused cached {}'.format(target_fn))
+                self._record_derivation(target_fn, source_sha256, command)
+                return target_fn
+
+        # The command writes to a temporary name, which is only renamed to
+        # the target once it succeeds, so an interrupted or failed command
+        # never leaves a partial derivative in place (or writes over a file
+        # shared with the cache)
+        partial_fn = _partial_filename(target_fn)
+        _remove(_path(self._root, partial_fn))
+
+        # static resource paths, resolved only if the command uses them
+        static = {k.lower(): _static(k) for k in _STATIC_RESOURCES
+                  if '{' + k.lower() + '}' in str(cmd_str)}
+        fields = dict(source=source, target=partial_fn, frame=frame, **static)
+
+        # The command is run in the bag root, so the relative filenames
+        # in the command line resolve without changing our own directory
+        cwd = self._root.path if self._root is not None else None
+
+        timeout = self.derive_timeout(target)
+        remaining = timeout
 
-        # shell=True required for Windows Subsystem for Linux
         try:
-            r = subprocess.run(cmd, shell=True, timeout=timeout)
-        except: # TimeoutExpired
-            logger.error("Process timed out: {}".format(target))
-            return None
-        if r.returncode == 0:
+            r = None
+            if self._chunked(target):
+                start = time.monotonic()
+                r = self._derive_chunked(target, source, partial_fn, timeout,
+                                         cwd)
+                if r.returncode != 0:
+                    logger.warning('Chunked encoding of {} failed; encoding '
+                                   'in one pass'.format(self.filename))
+                    r = None
+                    # the whole derivation is held to the one time limit
+                    remaining = timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        raise subprocess.TimeoutExpired(cmd_str, timeout)
+            if r is not None:
+                cmd = ' && '.join(' '.join(argv) for argv in r.args)
+            elif isinstance(cmd_str, Converter):
+                r = cmd_str.run(fields, remaining, cwd)
+                cmd = ' | '.join(' '.join(argv) for argv in r.args)
+            else:
+                # legacy shell command; shell=True required for Windows
+                # Subsystem for Linux
+                cmd = cmd_str.format(**fields)
+                r = _run_command(cmd, remaining, cwd)
+        except subprocess.TimeoutExpired:
+            _remove(_path(self._root, partial_fn))
+            raise DeriveTimeoutError(target, self.filename, timeout)
+        if r.returncode == 0 and os.path.exists(_path(self._root, partial_fn)):
+            _commit_partial(_path(self._root, partial_fn),
+                            _path(self._root, target_fn))
+            self._record_derivation(target_fn, source_sha256, command)
+            if cache is not None:
+                cache.add(key, target_fn)
             return target_fn
-        elif os.path.isfile(target_fn):
+        elif os.path.isfile(_path(self._root, partial_fn)):
             # Error code 1 is returned by some wkhtmltopdf if some
             # resources are inaccessible, even though the image/pdf generation
             # succeeds. If the derivative has successfully been created, just
@@ -1349,11 +3832,276 @@ class File:
             # the user was trying to update an existing derivative and the
             # command actually failed.
             logger.warning("Conversion error for command: {} (CODE: {})".format(cmd, r.returncode))
+            _commit_partial(_path(self._root, partial_fn),
+                            _path(self._root, target_fn))
+            self._record_derivation(target_fn, source_sha256, command)
             return target_fn
         else:
             logger.error("Conversion failed for command: {} (CODE: {})".format(cmd, r.returncode))
+            _remove(_path(self._root, partial_fn))
             return None
 
+    def _chunked(self, target):
+        """Return True if <target> is derived from the file by encoding
+        segments in parallel (see :py:data:`DERIVE_CHUNK_MIN_DURATION`).
+
+            >>> import odea
+            >>> workers, odea.DERIVE_CHUNK_WORKERS = odea.DERIVE_CHUNK_WORKERS, 2
+            >>> odea.File(duration='3600.0')._chunked('DF_H264')
+            True
+            >>> odea.File(duration='60.0')._chunked('DF_H264')
+            False
+            >>> odea.DERIVE_CHUNK_WORKERS = 1
+            >>> odea.File(duration='3600.0')._chunked('DF_H264')
+            False
+            >>> odea.DERIVE_CHUNK_WORKERS = workers
+
+        """
+        if target.upper().replace('-', '_') not in CHUNKED_TARGETS or \
+                    DERIVE_CHUNK_MIN_DURATION is None:
+            return False
+        # with a single worker, splitting and joining would only add work
+        if DERIVE_CHUNK_WORKERS < 2:
+            return False
+        try:
+            return float(self.duration) >= DERIVE_CHUNK_MIN_DURATION
+        except (TypeError, ValueError):
+            return False
+
+    def _derive_chunked(self, target, source, target_fn, timeout, cwd=None):
+        """Encode the video <source> to <target_fn> in segments, and return
+        a ``subprocess.CompletedProcess`` with the commands run.
+
+        The video stream is split (without re-encoding) at keyframes into
+        segments of about :py:data:`DERIVE_CHUNK_SECONDS`, which are encoded
+        by up to :py:data:`DERIVE_CHUNK_WORKERS` ffmpeg commands at once. The
+        encoded segments are joined with the concat demuxer, and the sound is
+        encoded from the source at the same time. The result is only accepted
+        if its duration matches that of the source, within
+        :py:data:`DERIVE_CHUNK_TOLERANCE` seconds.
+        """
+        target = target.upper().replace('-', '_')
+        ext = os.path.splitext(target_fn)[1]
+        ffmpeg = ['ffmpeg', '-loglevel', 'panic', '-nostdin']
+        deadline = time.monotonic() + timeout
+        workdir = tempfile.mkdtemp(prefix='.odea-chunks-',
+                    dir=os.path.dirname(_path(self._root, target_fn)))
+        try:
+            split = ffmpeg + ['-i', source, '-map', '0:v:0', '-c', 'copy',
+                    '-f', 'segment', '-segment_time', str(DERIVE_CHUNK_SECONDS),
+                    '-reset_timestamps', '1',
+                    os.path.join(workdir, 'source%05d.mkv')]
+            args = [split]
+            returncode = _run_pool(args, 1, timeout, cwd)
+            segments = sorted(fn for fn in os.listdir(workdir)
+                              if fn.startswith('source'))
+            if returncode != 0 or not segments:
+                return subprocess.CompletedProcess(args, returncode or 1)
+
+            options = _video_output_options(target)
+            encode = [ffmpeg + ['-i', os.path.join(workdir, fn)] + options +
+                      ['-an', os.path.join(workdir, 'video{:05d}{}'.format(
+                       n, ext))] for n, fn in enumerate(segments)]
+            args += encode
+            returncode = _run_pool(encode, DERIVE_CHUNK_WORKERS,
+                                   deadline - time.monotonic(), cwd)
+            if returncode != 0:
+                return subprocess.CompletedProcess(args, returncode)
+
+            # the concat demuxer reads the segments relative to the list
+            with open(os.path.join(workdir, 'segments.txt'), 'w') as f:
+                for argv in encode:
+                    f.write("file '{}'\n".format(os.path.basename(argv[-1])))
+            join = ffmpeg + ['-f', 'concat', '-i',
+                    os.path.join(workdir, 'segments.txt'), '-i', source,
+                    '-map', '0:v', '-map', '1:a?', '-c:v', 'copy'] + \
+                    CHUNKED_TARGETS[target] + [target_fn]
+            args.append(join)
+            returncode = _run_pool([join], 1, deadline - time.monotonic(),
+                                   cwd)
+            if returncode != 0:
+                return subprocess.CompletedProcess(args, returncode)
+
+            from moviepy.editor import VideoFileClip
+            clip = VideoFileClip(_path(self._root, target_fn))
+            duration = clip.duration
+            clip.close()
+            if abs(duration - float(self.duration)) > DERIVE_CHUNK_TOLERANCE:
+                logger.error('Chunked {} is {}s long, the source {}s'.format(
+                             target_fn, duration, self.duration))
+                _remove(_path(self._root, target_fn))
+                returncode = 1
+            return subprocess.CompletedProcess(args, returncode)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def derive_video(self, targets=None, frame=None, overwrite=False):
+        """Generate several video derivatives with a single ffmpeg command,
+        which decodes the source once and encodes each output from the same
+        frames. Return a dict of {target: filename}, with None for the
+        outputs that could not be generated.
+
+        :param targets: The targets to generate, from
+                        :py:data:`VIDEO_TARGETS` (by default, all of them).
+
+        The outputs have the same names, encoding options, and recorded
+        provenance as those generated separately by :py:meth:`derive`, so
+        either can stand in for the other. Outputs that already exist (unless
+        <overwrite> is True) or are in the :py:class:`DerivativeCache` are
+        not encoded again. Each output is checked separately: the outputs the
+        combined command did not complete are generated one at a time with
+        :py:meth:`derive`.
+
+        The outputs are then current in a :py:class:`DerivePlan` for the same
+        targets:
+
+            >>> import odea
+            >>> b = odea.test_bag()
+            >>> f = odea.load_sample_file('test_video.mp4')
+            >>> sorted(f.derive_video(frame=1).values()) # doctest: +ELLIPSIS
+            ['data/deriv/test_video.df-360p-vp9-400k....webm', 'data/deriv/test_video.df-h264....mp4', 'data/deriv/test_video.df-img-still....jpg']
+            >>> plan = odea.DerivePlan(f)
+            >>> for target, ext in odea.VIDEO_TARGETS.items():
+            ...     node = plan.add(target, target, ext, frame=1)
+            >>> plan.stale()
+            []
+
+        """
+
+        if targets is None:
+            targets = list(VIDEO_TARGETS)
+        targets = [t.upper().replace('-', '_') for t in targets]
+        if not frame:
+            frame = 0
+
+        results = {}
+        outputs = []
+        source = self.filename
+        source_sha256 = _file_digest(source, 'sha256', self._root)
+        cache = DerivativeCache(self._root) if DERIVATIVE_CACHE else None
+        for target in targets:
+            ext = VIDEO_TARGETS[target]
+            target_fn = self.derive_filename(target, ext)
+            command = _command_digest(_command_template(target), frame)
+            if overwrite is False and os.path.exists(
+                        _path(self._root, target_fn)):
+                results[target] = target_fn
+                continue
+            key = None
+            if cache is not None and source_sha256:
+                key = cache.key(source_sha256, target, ext, command)
+                if cache.fetch(key, target_fn):
+                    self._record_derivation(target_fn, source_sha256, command)
+                    results[target] = target_fn
+                    continue
+            partial_fn = _partial_filename(target_fn)
+            _remove(_path(self._root, partial_fn))
+            outputs.append((target, target_fn, partial_fn, command, key))
+
+        if not outputs:
+            return results
+
+        argv = ['ffmpeg', '-loglevel', 'panic', '-nostdin', '-i', source]
+        for target, target_fn, partial_fn, command, key in outputs:
+            argv += [a.format(frame=frame)
+                     for a in _video_output_options(target)]
+            argv.append(partial_fn)
+
+        cwd = self._root.path if self._root is not None else None
+        timeout = sum(self.derive_timeout(t) for t, *rest in outputs)
+        try:
+            proc = subprocess.Popen(argv, cwd=cwd,
+                                    start_new_session=(os.name == 'posix'))
+            returncode = _wait_processes([proc], timeout)
+        except subprocess.TimeoutExpired:
+            for target, target_fn, partial_fn, *rest in outputs:
+                _remove(_path(self._root, partial_fn))
+            raise DeriveTimeoutError(VIDEO_TARGET, self.filename, timeout)
+        except OSError as e:
+            logger.error('Could not run ffmpeg: {}'.format(e))
+            returncode = 127
+
+        for target, target_fn, partial_fn, command, key in outputs:
+            partial = _path(self._root, partial_fn)
+            if returncode == 0 and os.path.isfile(partial) and \
+                        os.path.getsize(partial) > 0:
+                _commit_partial(partial, _path(self._root, target_fn))
+                self._record_derivation(target_fn, source_sha256, command)
+                if key is not None:
+                    cache.add(key, target_fn)
+                results[target] = target_fn
+            else:
+                _remove(partial)
+                if returncode == 0:
+                    logger.error('No {} output from {}'.format(target,
+                                    ' '.join(argv)))
+                results[target] = None
+
+        # fall back to separate commands for the outputs that failed
+        failed = [target for target in targets if results.get(target) is None]
+        if failed:
+            logger.warning('Combined video derivation did not produce {} '
+                    '(CODE: {}); deriving separately'.format(
+                    ', '.join(failed), returncode))
+            for target in failed:
+                results[target] = self._derive(target, VIDEO_TARGETS[target],
+                                               frame, overwrite=True)
+        return results
+
+    def derive_timeout(self, target):
+        """Return the time limit, in seconds, for deriving <target> from the
+        file, according to :py:data:`DERIVE_TIMEOUTS`.
+
+            >>> import odea
+            >>> f = odea.File(size='1048576000', duration='3600.0')
+            >>> f.derive_timeout('DF_H264')
+            11100.0
+            >>> f.derive_timeout('DF_IMG_THUMB')
+            1030.0
+
+        """
+        base, per_mib, per_second = DERIVE_TIMEOUTS.get(
+                target.upper().replace('-', '_'), DERIVE_TIMEOUT_DEFAULT)
+        try:
+            mib = int(self.size) / 2**20
+        except (TypeError, ValueError):
+            try:
+                mib = os.stat(self.path).st_size / 2**20
+            except (OSError, TypeError):
+                mib = 0
+        try:
+            duration = float(self.duration)
+        except (TypeError, ValueError):
+            duration = mib
+        return float(base + per_mib * mib + per_second * duration)
+
+    def derive_filename(self, target, ext, target_dir=None):
+        """Return the filename of the derivative :py:meth:`derive` generates
+        for a target.
+
+            >>> import odea
+            >>> f = odea.File(basename='data/spam',
+            ...               identifier='48342ee3-9080-407e-9862-12ce05143499')
+            >>> f.derive_filename('DF_MP3', 'mp3')
+            'data/deriv/spam.df-mp3.48342ee3-9080-407e-9862-12ce05143499.mp3'
+
+        """
+        if not target_dir:
+            target_dir = DERIV_DIR
+        basename = os.path.join(target_dir, os.path.basename(self.basename))
+        return "{}.{}.{}.{}".format(basename,
+                    target.lower().replace('_','-'), self.identifier, ext)
+
+    def _record_derivation(self, target_fn, source_sha256, command):
+        """Record the input and command a derivative was generated from in
+        the :py:class:`DerivationIndex`."""
+        import dbm
+        try:
+            with DerivationIndex(self._root) as index:
+                index.set(target_fn, self.filename, source_sha256, command)
+        except dbm.error as e:
+            logger.warning('Derivation index unavailable: {}'.format(e))
+
     def thumbs(self):
         """Generate thumbnail images for the input filename.
 
@@ -1388,42 +4136,48 @@ class File:
 
         """
 
+        import mimetypes
         mtype, encoding = mimetypes.guess_type(self.filename)
 
+        # The thumbnails are made from the file itself, or from an image
+        # derived from it
+        plan = DerivePlan(self)
+        image = None
         if mtype is not None and mtype.startswith('image'):
-            f = self
+            pass
         elif self.ext in ('pdf'):
-            f = self
+            pass
         else:
+            image = 'image'
             # Make sure we have derivatives for non-image files
             if mtype is not None and mtype.startswith('text'):
                 # plain, css, html, javascript, xml, csv
                 # this can also be called manually
-                fn = self.derive('DF_IMG_SCREENSHOT', 'png', overwrite=False)
+                plan.add(image, 'DF_IMG_SCREENSHOT', 'png')
 
             elif mtype is not None and mtype.startswith('video'):
                 self.get_video_duration()
                 frame = int(float(self.duration // 2))
-                fn = self.derive('DF_IMG_STILL', 'jpg', frame, overwrite=False)
+                plan.add(image, 'DF_IMG_STILL', 'jpg', frame)
 
             elif self.ext in ('doc','docx', 'odt', 'xls', 'xlsx', 'ods'):
-                fn = self.derive('DF_PDF_DOC', 'pdf', overwrite=False)
+                plan.add(image, 'DF_PDF_DOC', 'pdf')
             else:
                 return (None, None)
 
-            if fn is None:
-                logger.error("Unable to find an image format for {}".format(
-                                self.filename))
-                return (None, None)
-            f = File(fn)
-            f.tag()
-            f.get_sha256()
-            f.get_mtime()
-            f.get_size()
-            f.save()
+        plan.add('thumb', 'DF_IMG_THUMB', 'png', input=image,
+                 target_dir=THUMBS_DIR, save=False)
+        plan.add('preview', 'DF_IMG_MED', 'png', input=image,
+                 target_dir=THUMBS_DIR, save=False)
+        results = plan.run()
 
-        self.thumb = f.derive('DF_IMG_THUMB', 'png', target_dir=THUMBS_DIR, overwrite=False)
-        self.preview = f.derive('DF_IMG_MED', 'png', target_dir=THUMBS_DIR, overwrite=False)
+        if image is not None and results[image] is None:
+            logger.error("Unable to find an image format for {}".format(
+                            self.filename))
+            return (None, None)
+
+        self.thumb = results['thumb']
+        self.preview = results['preview']
 
         return (self.thumb, self.preview)
 
@@ -1439,12 +4193,23 @@ class File:
                 size=_byte_size(self.size),
                 mtime=self.mtime)
 
-class Item:
+class Item(_Metadata):
+    """An Item in the archive, described by a tag file in
+    :py:data:`ITEM_METADATA_DIR`."""
+
+    _FIELDS = ('identifier', 'title', 'creator', 'contributor', 'coverage',
+               'date', 'description', 'language', 'publisher', 'relation',
+               'rights', 'source', 'subject', 'dcmi_type', 'embed_url', 'note')
+    __slots__ = _FIELDS
 
     def __init__(self, title=None, identifier=None, creator=None, subject=None,
             contributor=None, coverage=None, date=None, description=None,
             language=None, publisher=None, relation=None, rights=None,
-            source=None, dcmi_type=None, embed_url=None, note=None):
+            source=None, dcmi_type=None, embed_url=None, note=None, root=None):
+
+        # The BagRoot of the bag containing the item. If None, paths are
+        # relative to the current working directory.
+        self._root = root
 
         #: Identifier for the Item, represented by default as a version 4
         #: UUID hexadecimal string.
@@ -1538,14 +4303,10 @@ class Item:
         except:
             sys.exit("Unable to enter bag root")
 
-    def __str__(self):
-        attrs = vars(self)
-        return str(attrs)
-
     def json(self):
         """Return a json string representing the Bag"""
         # TODO: Docstring
-        return jsons.dumps(self, strip_nulls=False)
+        return self._json()
 
     def files(self):
         """Return a list of file objects, corresponding to the files on disk
@@ -1554,10 +4315,20 @@ class Item:
         """
         # TODO: Docstring
 
+        root = self._root
+        scan = _active_scans.get(root)
+        if scan is not None:
+            return [load_file(fn, root) for fn in scan.files(self.identifier)]
+
+        catalog = get_catalog(root)
+        if catalog is not None:
+            return [load_file(fn, root) for fn in _existing(catalog,
+                        catalog.item_files(self.identifier), root)]
+
         # search in data directory and subdirectories
-        g = sorted(pathlib.Path('.').glob(
+        g = sorted(pathlib.Path(_path(root, '.')).glob(
                     'data/**/*.{}.*'.format(self.identifier)))
-        return [load_file(str(p)) for p in g]
+        return [load_file(_path(root, str(p)), root) for p in g]
 
     def save(self):
         """Save the Item data structure to disk.
@@ -1574,11 +4345,12 @@ class Item:
 
         """
 
-        metadata = _make_tags(vars(self))
-        o = os.path.join(ITEM_METADATA_DIR,
-            '{}.txt'.format(self.identifier))
-        with open(o, 'w') as out:
-            out.write(metadata)
+        metadata = _make_tags(self._metadata())
+        tags, tag_mtime = _save_tags(self.tag_file(), metadata, self._root)
+
+        catalog = get_catalog(self._root)
+        if catalog is not None:
+            catalog.update_item(self.identifier, tags, tag_mtime)
 
 
     def html(self):
@@ -1675,7 +4447,7 @@ class Item:
 
 
         """
-        b = load_bag()
+        b = load_bag(self._root)
 
         body = [ self._html_preview(),
                  self._metadata_table()]
@@ -1700,7 +4472,7 @@ class Item:
         return _prettify(html)
 
     def _breadcrumbs(self):
-        b = load_bag() # to obtain the parent collection id
+        b = load_bag(self._root) # to obtain the parent collection id
 
         breadcrumbs = """
         <nav aria-label="breadcrumb">
@@ -1725,15 +4497,16 @@ class Item:
 
         src = self.src()
         if src:
-            f = load_file(src)
+            f = load_file(src, self._root)
             if getattr(f, 'preview', None):
                 return ('<p><img src="../{}" class="img-thumbnail" />'
                         '</p>').format(f.preview)
         return ''
 
-    def _html_row(self):
+    def _html_row(self, thumb=None):
         """Return an html row representing an item metadata, for use in
-        tabular index lists."""
+        tabular index lists. <thumb> is the thumbnail of the source file, if
+        already known ('' for none)."""
         row = ("""<div class="col"><div class="card h-100">
           {thumb}
           <div class="card-body">
@@ -1753,7 +4526,7 @@ class Item:
             identifier=self.identifier,
             title=self.title,
             subtitle=self._card_dcmi_type(),
-            thumb=self._card_thumb(),
+            thumb=self._card_thumb(thumb),
             description=_truncate(description)
             )
 
@@ -1762,20 +4535,32 @@ class Item:
             return '<h6 class="card-subtitle mb-2 text-muted">{}</h6>'.format(self.dcmi_type)
         return ''
 
-    def _card_thumb(self):
+    def _card_thumb(self, thumb=None):
         """Return a string corresponding to the item thumb filename."""
-        try:
-            src = load_file(self.src())
-        except:
-            return ''
-        if src and getattr(src, 'thumb', None):
-            return '<img src="../{}" class="card-img-top" />'.format(src.thumb)
+        if thumb is None:
+            try:
+                thumb = load_file(self.src(), self._root).thumb
+            except:
+                return ''
+        if thumb:
+            return '<img src="../{}" class="card-img-top" />'.format(thumb)
         return ''
 
     def src(self):
         """Return the path to the "SRC" file for the item"""
 
-        g = pathlib.Path('.').glob(
+        root = self._root
+        scan = _active_scans.get(root)
+        if scan is not None:
+            return scan.src(self.identifier)
+
+        catalog = get_catalog(root)
+        if catalog is not None:
+            src = _existing(catalog,
+                    catalog.item_files(self.identifier, format='SRC'), root)
+            return src[0] if src else None
+
+        g = pathlib.Path(_path(root, '.')).glob(
                     '**/*.SRC.{}.*'.format(self.identifier))
         g = list(g)
         try:
@@ -1784,18 +4569,28 @@ class Item:
             return None
 
     def tag_file(self):
-        # FIXME: extract from load_item()
+        """Return the path to the tag file for the item."""
 
-        return os.path.join(os.getcwd(), ITEM_METADATA_DIR,
+        return _path(self._root, ITEM_METADATA_DIR,
                     '{}.txt'.format(self.identifier))
 
 ######## BAG OBJECT ########
 
-class Bag:
+class Bag(_Metadata):
     """An abstract instance of a Bag."""
 
+    _FIELDS = ('archive', 'archive_url', 'title', 'identifier', 'creator',
+               'subject', 'contributor', 'coverage', 'date', 'description',
+               'language', 'publisher', 'relation', 'rights', 'source',
+               'preview', 'dcmi_type', 'note', 'payload_oxum')
+    __slots__ = _FIELDS
+
     def __init__(self, archive='odeum', archive_url=None, title=None,
-        identifier=None, creator=None, subject=None, contributor=None, coverage=None, date=None, description=None, language=None, publisher=None, relation=None, rights=None, source=None, preview=None, dcmi_type='Collection', note=None):
+        identifier=None, creator=None, subject=None, contributor=None, coverage=None, date=None, description=None, language=None, publisher=None, relation=None, rights=None, source=None, preview=None, dcmi_type='Collection', note=None, root=None):
+
+        # The BagRoot of the bag. If None, the bag is in the current working
+        # directory.
+        self._root = root
 
         #: The name of the archive to which this collection belongs.
         self.archive = archive
@@ -1892,10 +4687,6 @@ class Bag:
         except:
             sys.exit("Unable to enter bag root")
 
-    def __str__(self):
-        attrs = vars(self)
-        return str(attrs)
-
     def json(self):
         """Return a json string representing the Bag.
 
@@ -1925,7 +4716,7 @@ class Bag:
                 "title": "My test bag"
             }
         """
-        return jsons.dumps(self, strip_nulls=False)
+        return self._json()
 
     def tree(self, path='.'):
         """Print a directory tree representing the bag contents.
@@ -2050,7 +4841,16 @@ class Bag:
 
         body = [self._html_preview(), self._metadata_table()]
         body.append('<div class="row row-cols-1 row-cols-md-2 row-cols-lg-3 g-3">')
-        body.extend([i._html_row() for i in self.pub_items()])
+        # thumbnails of the source files, from the catalog if there is one
+        thumbs = {}
+        catalog = get_catalog(self._root)
+        if catalog is not None:
+            table = FileTable.from_catalog(catalog)
+            for n in table.select(format='SRC'):
+                thumbs[table.identifier(n)] = table.thumbs[n] or ''
+        with bag_scan(self._root):
+            body.extend([i._html_row(thumbs.get(i.identifier))
+                         for i in self.pub_items()])
         body.append('</div>')
 
         html = HTML_TEMPLATE.format(
@@ -2106,11 +4906,17 @@ class Bag:
         return ''
 
     def update_manifest(self, alg='sha512'):
-        """Update the Bag manifest.
+        """Update the Bag manifest. Return a report dict giving the number of
+        files whose digests were ``reused`` and ``rehashed``.
 
         :param alg: The algorithm to be used. Defaults to ``sha512``;
                     ``sha256`` can also be used.
 
+        Only new or changed payload files are hashed. A file is considered
+        unchanged if its size, modification time, and inode match the entry
+        recorded in the :py:class:`HashCache` when it was last hashed; its
+        digest is then taken from the cache.
+
         :Example:
 
             >>> import odea
@@ -2123,26 +4929,239 @@ class Bag:
             ...     out.write('Spam, eggs, bacon, and spam!')
             28
             >>> b.update_manifest()
+            {'reused': 0, 'rehashed': 1}
             >>> with open('manifest-sha512.txt', 'r') as manifest:
             ...     manifest.readlines() # doctest: +ELLIPSIS
             ['6aec3c2caf8a5f9984fd1... data/spam.txt']
 
+        Unchanged files are not hashed again:
+
+            >>> b.update_manifest()
+            {'reused': 1, 'rehashed': 0}
+
+        A file that was modified and has since been rehashed (e.g. by
+        :py:meth:`File.get_checksums`) is not hashed again either, but the
+        manifest gets its new digest:
+
+            >>> with open(spam, 'w') as out:
+            ...     out.write('Spam, spam, spam, and spam!')
+            27
+            >>> f = odea.load_file(spam)
+            >>> c = f.get_checksums(['sha512'])
+            >>> b.update_manifest()
+            {'reused': 1, 'rehashed': 0}
+            >>> with open('manifest-sha512.txt', 'r') as manifest:
+            ...     manifest.read() == '{} data/spam.txt'.format(f.sha512)
+            True
+            >>> b.verify(full=True)
+            1
+
+        The total size and number of payload files are saved to
+        ``bag-info.txt`` as the :py:attr:`payload_oxum`, with the standard
+        BagIt label:
+
+            >>> b.payload_oxum
+            '27.1'
+            >>> 'Payload-Oxum: 27.1' in open('bag-info.txt').read()
+            True
+
+        """
+
+        manifest_file = 'manifest-{}.txt'.format(alg)
+        table = FileTable.from_scan(self._root)
+        stats = {fn: table.stat(i) for i, fn in enumerate(table.filenames)}
+        report, octets = _write_manifest(manifest_file, table.filenames, alg,
+                                         self._root, stats)
+
+        # Record the BagIt Payload-Oxum ("<octets>.<files>") for fast checks
+        self.payload_oxum = '{}.{}'.format(octets, len(table))
+        self.save()
+        return report
+
+    def tag_files(self):
+        """Return a sorted list of the tag files in the bag: ``bagit.txt``,
+        ``bag-info.txt``, the payload manifests, the :py:data:`METADATA_LOG`
+        (if any), and the item and file metadata tag files."""
+
+        top = pathlib.Path(_path(self._root, '.'))
+        g = ['bagit.txt', 'bag-info.txt', METADATA_LOG]
+        g.extend(p.name for p in top.glob('manifest-*.txt'))
+        for d in (ITEM_METADATA_DIR, FILE_METADATA_DIR):
+            g.extend(str(p.relative_to(top)) for p in (top / d).glob('**/*')
+                        if not p.is_dir())
+        return sorted(fn for fn in g
+                        if os.path.isfile(_path(self._root, fn)))
+
+    def update_tagmanifest(self, alg='sha512'):
+        """Update the Bag tag manifest (``tagmanifest-<alg>.txt``), listing the
+        digests of the files returned by :py:meth:`tag_files`. Return a report
+        dict as for :py:meth:`update_manifest`.
+
+        As for the payload manifest, only tag files whose size, modification
+        time, or inode have changed since they were last hashed are read. This
+        should be called after :py:meth:`update_manifest`, which modifies
+        ``bag-info.txt`` and the payload manifest.
+
+            >>> import odea
+            >>> b = odea.test_bag()
+            >>> b.save()
+            >>> b.update_tagmanifest()
+            {'reused': 0, 'rehashed': 2}
+            >>> i = odea.Item(identifier=odea.NIL_UUID, title='test item')
+            >>> i.save()
+            >>> b.update_tagmanifest()
+            {'reused': 2, 'rehashed': 1}
+
+        """
+
+        manifest_file = 'tagmanifest-{}.txt'.format(alg)
+        report, octets = _write_manifest(manifest_file, self.tag_files(), alg,
+                                         self._root)
+        return report
+
+    def manifests(self):
+        """Return a dict of {alg: {filename: digest}} for every payload
+        manifest (``manifest-<alg>.txt``) in the bag root."""
+
+        m = {}
+        for p in sorted(pathlib.Path(_path(self._root, '.')).glob(
+                            'manifest-*.txt')):
+            alg = p.stem.partition('-')[2]
+            m[alg] = _load_manifest(str(p))
+        return m
+
+    def iter_verify(self, full=False):
+        """Check the payload against the bag manifests, yielding a
+        ``(filename, problem)`` tuple for each file as it is checked.
+        ``problem`` is None if the file is valid.
+
+        :param full: If False (the default), only ``stat`` is used: every
+                     manifest entry must exist, and the totals must match the
+                     :py:attr:`payload_oxum`. Sizes are also compared with
+                     those recorded in the :py:class:`HashCache`, if the bag
+                     has one; the cache is local to the bag (it is not
+                     copied with it) and is updated whenever a changed file
+                     is rehashed, so this does not show that the manifest is
+                     current. If True, every file is instead rehashed in
+                     parallel with all manifest algorithms at once, and the
+                     digests compared.
+
+        Payload files that are not listed in every manifest are also
+        reported.
+
+        .. seealso:: :py:meth:`verify`
         """
 
-        m = []
-        g = sorted(pathlib.Path(DATA_DIR).glob('**/*'))
-        for p in g:
-            if p.is_dir():
+        manifests = self.manifests()
+        if not manifests:
+            yield ('.', 'no payload manifest')
+            return
+        listed = set()
+        for entries in manifests.values():
+            listed.update(entries)
+
+        # files in the payload directory but not in the manifests
+        table = FileTable.from_scan(self._root)
+        rows = {fn: i for i, fn in enumerate(table.filenames)}
+        for fn in table.filenames:
+            for alg, entries in manifests.items():
+                if fn not in entries:
+                    yield (fn, 'not in manifest-{}.txt'.format(alg))
+
+        octets = 0
+        present = []
+        with HashCache(self._root) as cache:
+            for fn in sorted(listed):
+                if fn in rows:
+                    st_size = table.sizes[rows[fn]]
+                else:
+                    try:
+                        st_size = os.stat(_path(self._root, fn)).st_size
+                    except OSError:
+                        yield (fn, 'missing')
+                        continue
+                octets += st_size
+                present.append(fn)
+                if full:
+                    continue
+                size = cache.size(fn)
+                if size is not None and size != st_size:
+                    yield (fn, 'size {} does not match {} when hashed'.format(
+                                    st_size, size))
+                else:
+                    yield (fn, None)
+
+        oxum = getattr(self, 'payload_oxum', None)
+        if oxum and oxum != '{}.{}'.format(octets, len(listed)):
+            yield ('.', 'Payload-Oxum {}.{} does not match {}'.format(
+                            octets, len(listed), oxum))
+
+        if not full:
+            return
+        algs = sorted(manifests)
+        paths = {_path(self._root, fn): fn for fn in present}
+        for p, digests in get_hash_engine().hash_files(list(paths), algs):
+            fn = paths[p]
+            if digests is None:
+                yield (fn, 'unreadable')
                 continue
-            f = load_file(str(p))
-            c = getattr(f, alg, None)
-            if c is None:
-                c = f.get_checksum(alg)
-            m.append('{} {}'.format(c, f.filename))
+            problems = ['{} mismatch'.format(alg) for alg in algs
+                        if fn in manifests[alg]
+                        and manifests[alg][fn] != digests[alg]]
+            yield (fn, '; '.join(problems) or None)
 
-        with open('manifest-{}.txt'.format(alg), 'w') as manifest:
-            manifest.write('\r\n'.join(m))
-        return
+    def verify(self, full=False):
+        """Validate the payload against the bag manifests. Return the number
+        of files checked, or raise a :py:class:`BagValidationError` listing
+        every problem found.
+
+        :param full: Rehash every file (see :py:meth:`iter_verify`).
+
+            >>> import odea, os
+            >>> b = odea.test_bag()
+            >>> spam = os.path.join('data', 'spam.txt')
+            >>> with open(spam, 'w') as out:
+            ...     out.write('Spam, eggs, bacon, and spam!')
+            28
+            >>> b.update_manifest()
+            {'reused': 0, 'rehashed': 1}
+            >>> b.verify(full=True)
+            1
+            >>> with open(spam, 'w') as out:
+            ...     out.write('Spam, spam, spam, and spam!')
+            27
+            >>> b.verify()
+            Traceback (most recent call last):
+            ...
+            odea.BagValidationError: Bag validation failed: data/spam.txt: size 27 does not match 28 when hashed; .: Payload-Oxum 27.1 does not match 28.1
+
+        The standard ``Payload-Oxum`` element is read from ``bag-info.txt``,
+        so it is also checked in bags made by other BagIt tools:
+
+            >>> with open(spam, 'w') as out:
+            ...     out.write('Spam, eggs, bacon, and spam!')
+            28
+            >>> with open('bag-info.txt') as t:
+            ...     info = t.read()
+            >>> with open('bag-info.txt', 'w') as out:
+            ...     o = out.write(info.replace('Payload-Oxum: 28.1',
+            ...                                'Payload-Oxum: 1024.3'))
+            >>> odea.load_bag().verify()
+            Traceback (most recent call last):
+            ...
+            odea.BagValidationError: Bag validation failed: .: Payload-Oxum 28.1 does not match 1024.3
+
+        """
+
+        details = []
+        checked = set()
+        for fn, problem in self.iter_verify(full=full):
+            checked.add(fn)
+            if problem is not None:
+                details.append('{}: {}'.format(fn, problem))
+        if details:
+            raise BagValidationError('Bag validation failed', details)
+        return len(checked)
 
     def save(self):
         """Save the Bag data structure to disk in plain text format.
@@ -2158,15 +5177,23 @@ class Bag:
             ...     print(t)
         """
 
-        metadata = _make_tags(vars(self))
-        with open('bag-info.txt', 'w') as out:
-            out.write(metadata)
+        metadata = self._metadata()
+        # the standard BagIt label, which other tools read
+        oxum = metadata.pop('payload_oxum', None)
+        tags = [_make_tags(metadata)]
+        if oxum is not None:
+            tags.append('Payload-Oxum: {}'.format(oxum))
+        o = _path(self._root, 'bag-info.txt')
+        with open(o, 'w') as out:
+            out.write('\r\n'.join(t for t in tags if t))
+        tag_cache.discard(o)
 
     def items(self):
         """Return a list of Item objects for items in the bag.
 
         Items are retrieved from the tag files stored in the
-        :py:data:`ITEM_METADATA_DIR` directory.
+        :py:data:`ITEM_METADATA_DIR` directory (or the
+        :py:class:`MetadataLog`).
 
             >>> import odea
             >>> b = odea.test_bag()
@@ -2177,11 +5204,11 @@ class Bag:
             test_item
 
         """
-        g = pathlib.Path(ITEM_METADATA_DIR).glob('*.txt')
+        g = _tag_file_names(self._root, ITEM_METADATA_DIR)
         items_list = list()
-        for p in g:
-            item_uuid = re.findall(RE_UUID, str(p))
-            items_list.append(load_item(item_uuid[0]))
+        for tag_file in g:
+            item_uuid = re.findall(RE_UUID, os.path.basename(tag_file))
+            items_list.append(load_item(item_uuid[0], self._root))
 
         return items_list
 
@@ -2203,58 +5230,818 @@ class Bag:
             ['test item']
 
         """
+        root = self._root
+        pub = set(p.stem for p in
+                    pathlib.Path(_path(root, HTML_DIR)).glob('*.html'))
+
+        catalog = get_catalog(root)
+        if catalog is not None:
+            identifiers = catalog.items()
+        else:
+            identifiers = [pathlib.Path(fn).stem for fn in
+                    _tag_file_names(root, ITEM_METADATA_DIR)]
+
         # sort by uuid
-        g = sorted(pathlib.Path(HTML_DIR).glob('*.html'))
-        pub = [p.stem for p in g]
-        return [i for i in self.items() if i.identifier in pub]
+        return [load_item(i, root) for i in sorted(identifiers) if i in pub]
+
+######## DERIVATION SCHEDULER ########
+
+def _partial_filename(filename):
+    """Return the temporary name under which a derivative is written until
+    it is complete: a hidden file in the same directory, with the same
+    extension (which some tools use to choose the output format).
+
+        >>> import odea
+        >>> odea._partial_filename('data/deriv/spam.df-mp3.x.mp3')
+        'data/deriv/.spam.df-mp3.x.odea-part.mp3'
+
+    """
+    d, name = os.path.split(filename)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(d, '.{}.odea-part{}'.format(stem, ext))
+
+def _remove(path):
+    """Remove a file or directory tree, if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def _commit_partial(partial, target):
+    """Move a completed derivative from its temporary name to <target>,
+    replacing any previous version."""
+    if os.path.isdir(partial) and os.path.isdir(target):
+        shutil.rmtree(target)
+    os.replace(partial, target)
+
+def _run_command(cmd, timeout, cwd=None):
+    """Run a shell command in a new process group, and return the
+    ``subprocess.CompletedProcess``. If it is still running after <timeout>
+    seconds, the whole group (the shell and every program it started) is
+    stopped, and killed if it has not exited after
+    :py:data:`DERIVE_KILL_GRACE` seconds; ``subprocess.TimeoutExpired`` is
+    then raised."""
+
+    proc = subprocess.Popen(cmd, shell=True, cwd=cwd,
+                            start_new_session=(os.name == 'posix'))
+    return subprocess.CompletedProcess(cmd, _wait_processes([proc], timeout))
+
+def _run_pool(argvs, workers, timeout, cwd=None):
+    """Run commands (argument lists), up to <workers> at a time, each in a
+    new process group, and return the first non-zero return code, or 0. The
+    remaining commands are not started once one has failed. If they have not
+    all finished within <timeout> seconds, the running groups are stopped as
+    for :py:func:`_wait_processes`, and ``subprocess.TimeoutExpired`` is
+    raised."""
+
+    deadline = time.monotonic() + timeout
+    pending = list(argvs)
+    running = []
+    returncode = 0
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                try:
+                    running.append(subprocess.Popen(pending.pop(0), cwd=cwd,
+                                   start_new_session=(os.name == 'posix')))
+                except OSError as e:
+                    logger.error('Could not run command: {}'.format(e))
+                    returncode = returncode or 127
+                    pending = []
+            for proc in [p for p in running if p.poll() is not None]:
+                running.remove(proc)
+                if proc.returncode != 0:
+                    returncode = returncode or proc.returncode
+                    pending = []
+            if running:
+                if time.monotonic() > deadline:
+                    raise subprocess.TimeoutExpired(running[0].args, timeout)
+                time.sleep(0.1)
+    except BaseException:
+        for proc in running:
+            _kill_group(proc)
+        raise
+    return returncode
+
+def _wait_processes(procs, timeout):
+    """Wait for processes, each started in its own process group, to exit
+    within <timeout> seconds in total. Return the first non-zero return code,
+    or 0. On timeout (or interrupt) the groups are stopped with
+    :py:func:`_kill_group` before the exception is raised."""
+
+    deadline = time.monotonic() + timeout
+    try:
+        for proc in procs:
+            proc.wait(timeout=max(0, deadline - time.monotonic()))
+    except BaseException:
+        # e.g. TimeoutExpired or KeyboardInterrupt: do not leave the
+        # commands running
+        for proc in procs:
+            _kill_group(proc)
+        raise
+    for proc in procs:
+        if proc.returncode != 0:
+            return proc.returncode
+    return 0
+
+def _kill_group(proc):
+    """Stop the process group led by <proc>, then kill it if necessary."""
+    import signal
+    posix = os.name == 'posix'
+    for sig in (signal.SIGTERM, getattr(signal, 'SIGKILL', signal.SIGTERM)):
+        try:
+            if posix:
+                os.killpg(proc.pid, sig)
+            else:
+                proc.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+        try:
+            proc.wait(timeout=DERIVE_KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            continue
+        if posix:
+            # the shell may be gone while the programs it started are not
+            try:
+                os.killpg(proc.pid, 0)
+            except (ProcessLookupError, PermissionError):
+                return
+            continue
+        return
+
+def _command_template(target):
+    """Return the command for a derivation target: a :py:class:`Converter`
+    from :py:data:`CONVERTERS`, or else the shell command template
+    :py:data:`CMD_<TARGET>`."""
+    target = target.upper().replace('-', '_')
+    if target in CONVERTERS:
+        return CONVERTERS[target]
+    return globals()['CMD_' + target]
+
+# Programs that run another command, and are skipped when naming the tool
+_COMMAND_WRAPPERS = ('xvfb-run', 'nice', 'ionice', 'env', 'timeout')
+
+def _command_tool(cmd_str):
+    """Return the name of the program run by a derivation command template.
+
+        >>> import odea
+        >>> odea._command_tool(odea.CMD_DF_IMG_SCREENSHOT)
+        'wkhtmltoimage'
+        >>> odea._command_tool(odea.CMD_DF_PDF_HTML)
+        'wkhtmltopdf'
+
+    """
+    for command in cmd_str.split(';'):
+        words = [w for w in command.split()
+                 if not w.startswith('-') and '=' not in w]
+        while words and words[0] in _COMMAND_WRAPPERS:
+            words.pop(0)
+        # skip shell builtins, such as "read" and "mkdir"
+        if words and words[0] not in ('read', 'mkdir'):
+            return os.path.basename(words[0])
+    return None
+
+class JobQueue:
+    """A durable record of derivation jobs, stored in :py:data:`JOB_QUEUE`.
+
+    :param root: The :py:class:`BagRoot` of the bag. Defaults to the current
+                 directory.
+
+    A :py:class:`DeriveScheduler` given a queue records each job when it is
+    submitted ("pending"), started ("running", counting the attempt), and
+    finished ("done", "failed", or "timeout"), committing each change
+    immediately. If
+    the process is interrupted, the jobs that were not done are returned by
+    :py:meth:`unfinished`, to be submitted again. Since derivatives are
+    written under a temporary name until complete (see
+    :py:meth:`File.derive`), a job that was running leaves no partial output
+    behind.
+
+        >>> import odea
+        >>> b = odea.test_bag()
+        >>> with odea.JobQueue() as q:
+        ...     id = q.add('data/spam.SRC.x.wav', 'DF_MP3', 'mp3')
+        ...     q.start(id)
+        ...     [job['target'] for job in q.unfinished()]
+        ['DF_MP3']
+        >>> with odea.JobQueue() as q:
+        ...     q.finish(id, 'done', 'data/deriv/spam.df-mp3.x.mp3')
+        ...     q.counts()
+        {'done': 1}
+
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            source TEXT,
+            target TEXT,
+            ext TEXT,
+            frame TEXT,
+            target_dir TEXT,
+            save INTEGER,
+            state TEXT,
+            attempts INTEGER DEFAULT 0,
+            output TEXT,
+            error TEXT,
+            updated TEXT,
+            UNIQUE (source, target, ext, target_dir)
+        );
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+    """
+
+    #: The states of a job. "timeout" is a failure in which the command
+    #: ran out of time (see :py:data:`DERIVE_TIMEOUTS`).
+    STATES = ('pending', 'running', 'done', 'failed', 'timeout')
+
+    def __init__(self, root=None, filename=JOB_QUEUE):
+
+        #: Path to the queue database.
+        self.filename = _path(root, filename)
+
+        self._root = root
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        import sqlite3
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._db.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the queue."""
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+    def _execute(self, sql, args=()):
+        """Run a statement and commit it, holding the lock. Return the
+        fetched rows."""
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+            self._db.commit()
+            return rows
+
+    def add(self, source, target, ext, frame=None, target_dir=None,
+            save=True, reset=True):
+        """Record a pending job. A job for the same derivative that is
+        already recorded is set pending again, and its attempts are counted
+        from zero unless <reset> is False (when it is being resumed). Return
+        the job id."""
+        key = (source, target, ext, target_dir or '')
+        self._execute('INSERT OR IGNORE INTO jobs (source, target, ext, '
+                'target_dir) VALUES (?, ?, ?, ?)', key)
+        self._execute('UPDATE jobs SET state = ?, frame = ?, save = ?, '
+                'attempts = CASE WHEN ? THEN 0 ELSE attempts END, '
+                'updated = ? WHERE source = ? AND target = ? AND ext = ? '
+                'AND target_dir = ?', ('pending', frame, int(save),
+                int(reset), _isotime(time.time())) + key)
+        return self._execute('SELECT id FROM jobs WHERE source = ? AND '
+                'target = ? AND ext = ? AND target_dir = ?', key)[0][0]
+
+    def start(self, id):
+        """Mark a job as running, and count the attempt."""
+        self._execute('UPDATE jobs SET state = ?, attempts = attempts + 1, '
+                'updated = ? WHERE id = ?',
+                ('running', _isotime(time.time()), id))
+
+    def finish(self, id, state, output=None, error=None):
+        """Record the outcome of a job."""
+        self._execute('UPDATE jobs SET state = ?, output = ?, error = ?, '
+                'updated = ? WHERE id = ?',
+                (state, output, error, _isotime(time.time()), id))
+
+    def unfinished(self, max_attempts=None):
+        """Return the jobs that are not done (including those that were
+        running when the process stopped), in the order they were added, as
+        dicts. Jobs already attempted <max_attempts> times (defaulting to
+        :py:data:`DERIVE_MAX_ATTEMPTS`) are left out."""
+        if max_attempts is None:
+            max_attempts = DERIVE_MAX_ATTEMPTS
+        with self._lock:
+            cursor = self._db.execute('SELECT * FROM jobs WHERE state != ? '
+                    'AND attempts < ? ORDER BY id', ('done', max_attempts))
+            names = [c[0] for c in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def counts(self):
+        """Return a dict of {state: number of jobs}."""
+        return dict(self._execute(
+                'SELECT state, count(*) FROM jobs GROUP BY state'))
+
+    def clear(self, state='done'):
+        """Forget the jobs in a state."""
+        self._execute('DELETE FROM jobs WHERE state = ?', (state,))
+
+class DeriveJob:
+    """A derivative to be generated by a :py:class:`DeriveScheduler`; the
+    arguments are those of :py:meth:`File.derive`."""
+
+    def __init__(self, file, target, ext, frame=None, save=True, **kwargs):
+
+        #: The :py:class:`File` to derive from.
+        self.file = file
+
+        #: The derivation target, e.g. "DF_H264".
+        self.target = target
+
+        #: The extension of the derivative.
+        self.ext = ext
+
+        #: The page, image, or frame number to use.
+        self.frame = frame
+
+        #: Whether the derivative is recorded by the scheduler when finished.
+        self.save = save
+
+        #: Other keyword arguments to :py:meth:`File.derive`.
+        self.kwargs = kwargs
+
+        try:
+            cmd_str = 'ffmpeg' if target == VIDEO_TARGET else \
+                    str(_command_template(target))
+        except KeyError:
+            cmd_str = ''
+
+        #: The program run by the derivation command.
+        self.tool = _command_tool(cmd_str)
+
+        #: The number of CPUs the command is expected to use.
+        self.cost = DERIVE_TOOL_COST.get(self.tool, 1)
+        if target != VIDEO_TARGET and file._chunked(target):
+            self.cost *= DERIVE_CHUNK_WORKERS
+
+        #: The filename of the derivative, once generated (None on failure).
+        self.result = None
+
+        #: For :py:data:`VIDEO_TARGET`, the filename of each output by target
+        #: (None for those that failed). The targets are given as <ext>,
+        #: joined with "+".
+        self.results = None
+
+        #: Time taken by the command, in seconds.
+        self.elapsed = None
+
+        #: The outcome of the job: None until it has run, then "done",
+        #: "failed", or "timeout".
+        self.state = None
+
+        #: The reason the derivative could not be generated.
+        self.error = None
+
+        #: The id of the job in the :py:class:`JobQueue`, if any.
+        self.id = None
+
+    def __repr__(self):
+        return '<DeriveJob {} {}>'.format(self.target, self.file.filename)
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            if self.target == VIDEO_TARGET:
+                self.results = self.file.derive_video(self.ext.split('+'),
+                        self.frame, self.kwargs.get('overwrite', False))
+                # the job is done only if every output was generated
+                done = [fn for fn in self.results.values() if fn is not None]
+                if len(done) == len(self.results):
+                    self.result = done[0]
+                elif done:
+                    self.error = 'not all outputs were generated'
+            else:
+                self.result = self.file._derive(self.target, self.ext,
+                                                self.frame, **self.kwargs)
+        except DeriveTimeoutError as e:
+            logger.error(str(e))
+            self.state = 'timeout'
+            self.error = str(e)
+        except Exception as e:
+            logger.error('Derivation {} failed for {}: {}'.format(
+                            self.target, self.file.filename, e))
+            self.error = str(e)
+        if self.state is None:
+            self.state = 'done' if self.result is not None else 'failed'
+        if self.result is None and self.error is None:
+            self.error = 'conversion failed'
+        self.elapsed = time.monotonic() - start
+
+class DeriveScheduler:
+    """Generate many derivatives at once, running as many derivation commands
+    in parallel as the CPU budget and the per-tool limits allow.
+
+    :param budget: Number of CPUs the commands may keep busy. Defaults to
+                   :py:data:`DERIVE_CPU_BUDGET`. Each command counts for
+                   the cost of its tool in :py:data:`DERIVE_TOOL_COST`.
+
+    :param limits: Maximum number of concurrent commands for each tool.
+                   Defaults to :py:data:`DERIVE_TOOL_LIMITS`.
+
+    :param record: A function called with each finished :py:class:`DeriveJob`
+                   whose derivative was generated, on the thread iterating
+                   over :py:meth:`run`. The default, :py:func:`record_derivative`,
+                   saves the file metadata of the derivative.
+
+    :param queue:  A :py:class:`JobQueue` in which to record the state of
+                   each job.
+
+    Jobs are started in the order they were submitted, except that a job
+    whose tool is at its limit is passed over in favour of later jobs for
+    other tools. A single job costing more than the whole budget runs on its
+    own.
+
+        >>> import odea
+        >>> b = odea.test_bag()
+        >>> f = odea.load_sample_file('test_wav_sound.wav')
+        >>> s = odea.DeriveScheduler(budget=2)
+        >>> s.submit(f, 'DF_MP3', 'mp3')
+        <DeriveJob DF_MP3 data/test_wav_sound.SRC.0000000-0000-0000-0000-000000000000.wav>
+        >>> [job.result for job in s.run()]
+        ['data/deriv/test_wav_sound.df-mp3.0000000-0000-0000-0000-000000000000.mp3']
+
+    """
+
+    def __init__(self, budget=None, limits=None, record=None, queue=None):
+
+        #: Number of CPUs the commands may keep busy.
+        self.budget = budget or DERIVE_CPU_BUDGET
+
+        #: Maximum number of concurrent commands for each tool.
+        self.limits = DERIVE_TOOL_LIMITS if limits is None else limits
+
+        self.record = record or record_derivative
+        self.queue = queue
+        self._pending = []
+
+    def submit(self, file, target, ext, frame=None, save=True, resume=False,
+               **kwargs):
+        """Add a derivative of <file> to be generated. Return the
+        :py:class:`DeriveJob`. If <save> is False, the derivative is not
+        recorded when it is finished. If <resume> is True, the job is a retry
+        of one in the :py:class:`JobQueue`, and its earlier attempts still
+        count."""
+        job = DeriveJob(file, target, ext, frame, save, **kwargs)
+        if self.queue is not None:
+            job.id = self.queue.add(file.filename, target, ext, frame,
+                                    kwargs.get('target_dir'), save,
+                                    reset=not resume)
+        self._pending.append(job)
+        return job
+
+    def _startable(self, running, used):
+        """Return the first pending job that can be started now, or None."""
+        tools = collections.Counter(job.tool for job in running)
+        for job in self._pending:
+            limit = self.limits.get(job.tool)
+            if limit is not None and tools[job.tool] >= limit:
+                continue
+            if running and used + job.cost > self.budget:
+                continue
+            return job
+        return None
+
+    def run(self):
+        """Run the submitted jobs. Yield each :py:class:`DeriveJob` as it
+        finishes, after its derivative has been recorded."""
+
+        import queue
+        finished = queue.Queue()
+
+        def work(job):
+            try:
+                job.run()
+            finally:
+                finished.put(job)
+
+        running = set()
+        used = 0
+        while self._pending or running:
+            job = self._startable(running, used)
+            while job is not None:
+                self._pending.remove(job)
+                running.add(job)
+                used += job.cost
+                if self.queue is not None:
+                    self.queue.start(job.id)
+                threading.Thread(target=work, args=(job,),
+                                 name='odea-derive', daemon=True).start()
+                job = self._startable(running, used)
+
+            job = finished.get()
+            running.discard(job)
+            used -= job.cost
+            if job.save and (job.result is not None or
+                        job.results and any(job.results.values())):
+                try:
+                    self.record(job)
+                except Exception as e:
+                    logger.error('Could not record {}: {}'.format(
+                                    job.result, e))
+            if self.queue is not None:
+                self.queue.finish(job.id, job.state, job.result, job.error)
+            yield job
+
+def record_derivative(job):
+    """Tag a newly generated derivative (or each output of a combined
+    derivation) and save its file metadata (the default action of a
+    :py:class:`DeriveScheduler`)."""
+
+    f = None
+    filenames = job.results.values() if job.results else [job.result]
+    for filename in filenames:
+        if filename is None:
+            continue
+        f = load_file(filename, job.file._root)
+        f.tag()
+        f.get_checksums()
+        f.get_mtime()
+        f.get_size()
+        f.save()
+    return f
+
+class DeriveNode:
+    """A derivative in a :py:class:`DerivePlan`; see :py:meth:`DerivePlan.add`."""
+
+    def __init__(self, name, target, ext, input=None, frame=None,
+            target_dir=None, save=True):
+        self.name = name
+        self.target = target
+        self.ext = ext
+        self.input = input
+        self.frame = frame
+        self.target_dir = target_dir
+        self.save = save
+
+    def __repr__(self):
+        return '<DeriveNode {}>'.format(self.name)
+
+class DerivePlan:
+    """The derivatives of a file, as a graph in which each derivative is
+    generated either from the file itself or from another derivative (e.g.
+    source → pdf → thumbnail).
+
+    Every derivative generated by :py:meth:`File.derive` is recorded in the
+    :py:class:`DerivationIndex` with the sha256 digest of its input and a
+    digest of its command template. A derivative is stale if it does not
+    exist, if its input or command has changed since it was generated, or if
+    its input is itself stale; :py:meth:`run` regenerates exactly the stale
+    derivatives, each after the derivative it depends on.
+
+        >>> import odea
+        >>> b = odea.test_bag()
+        >>> f = odea.load_sample_file('test_plain-text.txt')
+        >>> plan = odea.DerivePlan(f)
+        >>> plan.add('image', 'DF_IMG_SCREENSHOT', 'png')
+        <DeriveNode image>
+        >>> plan.add('thumb', 'DF_IMG_THUMB', 'png', input='image',
+        ...          target_dir=odea.THUMBS_DIR, save=False)
+        <DeriveNode thumb>
+        >>> plan.stale()
+        [<DeriveNode image>, <DeriveNode thumb>]
+        >>> plan.run()['thumb']
+        'thumbs/test_plain-text.df-img-thumb.0000000-0000-0000-0000-000000000000.png'
+        >>> plan.stale()
+        []
+
+    """
+
+    def __init__(self, file):
+
+        #: The :py:class:`File` the derivatives are generated from.
+        self.file = file
+
+        #: The derivatives, by name, in the order they were added.
+        self.nodes = collections.OrderedDict()
+
+        #: After :py:meth:`run`, the filename of each derivative by name, or
+        #: None if it could not be generated.
+        self.results = {}
+
+    def add(self, name, target, ext, input=None, frame=None, target_dir=None,
+            save=True):
+        """Add a derivative to the plan. Return the :py:class:`DeriveNode`.
+
+        :param name:   A name for the derivative within the plan.
+
+        :param input:  The name of the derivative this one is generated from,
+                       which must already have been added; None for the file
+                       itself.
+
+        :param save:   Whether the derivative is tagged and its metadata saved
+                       (see :py:func:`record_derivative`).
+
+        The other arguments are those of :py:meth:`File.derive`.
+        """
+        if input is not None and input not in self.nodes:
+            raise KeyError('Unknown derivative {}'.format(input))
+        node = DeriveNode(name, target, ext, input, frame, target_dir, save)
+        self.nodes[name] = node
+        return node
+
+    def output(self, name):
+        """Return the filename of a derivative."""
+        node = self.nodes[name]
+        return self.file.derive_filename(node.target, node.ext, node.target_dir)
+
+    def _input(self, node):
+        if node.input is None:
+            return self.file.filename
+        return self.output(node.input)
+
+    def stale(self):
+        """Return a list of the derivatives that need to be generated, in the
+        order they can be generated."""
+
+        import dbm
+        root = self.file._root
+        records = {}
+        try:
+            with DerivationIndex(root) as index:
+                for name in self.nodes:
+                    records[name] = index.get(self.output(name))
+        except dbm.error as e:
+            logger.warning('Derivation index unavailable: {}'.format(e))
+
+        stale = []
+        names = set()
+        digests = {}
+        for name, node in self.nodes.items():
+            if node.input in names or not os.path.exists(
+                        _path(root, self.output(name))):
+                stale.append(node)
+                names.add(name)
+                continue
+            record = records.get(name)
+            if record is None:
+                # generated before derivations were recorded
+                continue
+            command = _command_digest(_command_template(node.target),
+                                      node.frame)
+            source = self._input(node)
+            if source not in digests:
+                digests[source] = _file_digest(source, 'sha256', root)
+            if (record.get('command') != command or
+                        record.get('sha256') != digests[source]):
+                stale.append(node)
+                names.add(name)
+        return stale
+
+    def run(self, scheduler=None):
+        """Generate the stale derivatives. Return a dict of the filenames of
+        all the derivatives by name (None for those that failed).
+
+        :param scheduler: A :py:class:`DeriveScheduler` to run the derivation
+                          commands; a new one is used by default.
+        """
+        return run_plans([self], scheduler)[0]
+
+def run_plans(plans, scheduler=None):
+    """Generate the stale derivatives of several :py:class:`DerivePlan`
+    objects together, so that independent derivatives of all the files run in
+    parallel. Return a list of the results of each plan (see
+    :py:meth:`DerivePlan.run`)."""
+
+    if scheduler is None:
+        scheduler = DeriveScheduler()
+    waiting = []
+    for plan in plans:
+        stale = plan.stale()
+        plan.results = {name: plan.output(name) for name in plan.nodes
+                        if plan.nodes[name] not in stale}
+        waiting.append((plan, stale))
+
+    while any(stale for plan, stale in waiting):
+        jobs = {}
+        progress = False
+        for plan, stale in waiting:
+            # video outputs of the source are made from a single decode
+            # (except those encoded in segments)
+            video = [node for node in stale if node.input is None and
+                     node.target_dir is None and
+                     VIDEO_TARGETS.get(node.target.upper().replace('-', '_'))
+                     == node.ext and not plan.file._chunked(node.target)]
+            if len(video) > 1:
+                frame = next((node.frame for node in video if node.frame),
+                             None)
+                job = scheduler.submit(plan.file, VIDEO_TARGET,
+                        '+'.join(node.target for node in video), frame,
+                        save=all(node.save for node in video),
+                        overwrite=True)
+                jobs[job] = (plan, video)
+                for node in video:
+                    stale.remove(node)
+                progress = True
+            for node in list(stale):
+                if node.input is not None and node.input not in plan.results:
+                    continue
+                stale.remove(node)
+                progress = True
+                if node.input is None:
+                    f = plan.file
+                elif plan.results[node.input] is None:
+                    plan.results[node.name] = None
+                    continue
+                else:
+                    f = load_file(plan.results[node.input], plan.file._root)
+                job = scheduler.submit(f, node.target, node.ext, node.frame,
+                        save=node.save, overwrite=True,
+                        target_dir=node.target_dir)
+                jobs[job] = (plan, [node])
+        if not progress:
+            break
+        for job in scheduler.run():
+            if job in jobs:
+                plan, nodes = jobs[job]
+                for node in nodes:
+                    if job.results is not None:
+                        plan.results[node.name] = job.results.get(
+                                node.target.upper().replace('-', '_'))
+                    else:
+                        plan.results[node.name] = job.result
+    return [plan.results for plan in plans]
 
 ######## CONSTRUCTORS ########
 
-def load_bag():
+def load_bag(root=None):
     """Look for an existing 'bag-info.txt' metadata file and load
-    as a Bag object. If no metadata file exists, create a new Bag object."""
+    as a Bag object. If no metadata file exists, create a new Bag object.
+
+    :param root: The :py:class:`BagRoot` of the bag. If None, the bag
+                 containing the current directory is used.
+    """
 
-    root = get_root(os.getcwd())
+    if root is None:
+        root = BagRoot.find(os.getcwd())
     if root is None:
         new()
-        root = os.getcwd()
-    b = Bag()
-    tag_file = os.path.join(root, 'bag-info.txt' )
+        root = BagRoot.find(os.getcwd())
+    b = Bag(root=root)
+    tag_file = root.join('bag-info.txt')
     if os.path.exists(tag_file):
-        tags = _load_tag_file(tag_file)
+        tags = _load_tag_file(tag_file, get_tag_snapshot(root))
         for key in tags:
-            setattr(b, key, tags[key])
+            # Payload-Oxum (written as "payload oxum" by older versions)
+            if key in ('payload-oxum', 'payload_oxum'):
+                b.payload_oxum = tags[key]
+            else:
+                setattr(b, key, tags[key])
     return b
 
-def load_item(item_uuid):
+def load_item(item_uuid, root=None):
     """Look for an existing metadata file matching the item uuid and load
     as an Item object. If no metadata file exists, create a new Item object.
 
     :param item_uuid: The UUID for an item in the archive.
+    :param root: The :py:class:`BagRoot` of the bag. If None, the bag
+                 containing the current directory is used.
     """
 
     # TODO: Docstring (see load_file())
-    root = get_root(os.getcwd())
+    if root is None:
+        root = BagRoot.find(os.getcwd())
     if root is None:
         logger.error("Load item: Could not locate bag root from dir {}".format(
                         os.getcwd() ))
         return None
 
-    tag_file = os.path.join(root, ITEM_METADATA_DIR,
-                '{}.txt'.format(item_uuid))
+    tag_file = root.join(ITEM_METADATA_DIR, '{}.txt'.format(item_uuid))
 
-    i = Item(identifier=item_uuid)
-    if os.path.exists(tag_file):
-        tags = _load_tag_file(tag_file)
+    i = Item(identifier=item_uuid, root=root)
+    log = get_metadata_log(root)
+    tags = log.get(tag_file) if log is not None else None
+    if tags is not None:
+        for key in tags:
+            setattr(i, key, tags[key])
+    elif os.path.exists(tag_file):
+        catalog = get_catalog(root)
+        snapshot = get_tag_snapshot(root)
+        tags = _cached_tags(tag_file, snapshot)
+        if tags is None and catalog is not None:
+            tag_mtime = _tag_mtime(tag_file)
+            tags = catalog.item_tags(item_uuid, tag_mtime)
+            if tags is not None:
+                _cache_tags(tag_file, tags, snapshot)
+        if tags is None:
+            tags = _load_tag_file(tag_file, snapshot)
+            if catalog is not None:
+                catalog.update_item(item_uuid, tags, tag_mtime)
         for key in tags:
             setattr(i, key, tags[key])
     return i
 
-def load_file(filename):
+def load_file(filename, root=None):
     """Look for an existing metadata file matching the filepath and load
     as a File object.
 
     :param filename: The path to a file in the current Bag.
+    :param root: The :py:class:`BagRoot` of the bag. If given, a relative
+                 <filename> is taken relative to the bag root; otherwise the
+                 root is located from <filename>. The current directory is
+                 not changed.
 
     The metadata document is matched against the :py:attr:`File.identifier` and
     :py:attr:`File.format` properties; this function will ignore the filepath
@@ -2285,22 +6072,39 @@ def load_file(filename):
         File(filename='data/test.txt', ...)
 
     """
-    root = get_root(filename)
     if root is None:
-        logger.error("load file {}: Could not locate bag root".format(filename))
-        return None
-    os.chdir(root) # necessary for File(), which takes relative path
-    filename = str(pathlib.Path(filename).resolve().relative_to(root))
-    f = File(filename)
+        root = BagRoot.find(filename)
+        if root is None:
+            logger.error("load file {}: Could not locate bag root".format(
+                            filename))
+            return None
+        filename = root.relative(filename)
+    elif os.path.isabs(filename):
+        filename = root.relative(filename)
+    f = File(filename, root=root)
     f.get_uuid()
     if not f.identifier in filename:
         return f
     f.get_filename_parts()
     if f.format:
-        tag_file = os.path.join(FILE_METADATA_DIR,
-            '{}.{}.txt'.format(f.identifier, f.format))
-        if os.path.exists(tag_file):
-            tags = _load_tag_file(tag_file)
+        tag_file = f.tag_file()
+        log = get_metadata_log(root)
+        tags = log.get(tag_file) if log is not None else None
+        if tags is None and os.path.exists(tag_file):
+            catalog = get_catalog(root)
+            snapshot = get_tag_snapshot(root)
+            tags = _cached_tags(tag_file, snapshot)
+            if tags is None and catalog is not None:
+                tag_mtime = _tag_mtime(tag_file)
+                tags = catalog.file_tags(filename, tag_mtime)
+                if tags is not None:
+                    _cache_tags(tag_file, tags, snapshot)
+            if tags is None:
+                tags = _load_tag_file(tag_file, snapshot)
+                if catalog is not None and filename.startswith(DATA_DIR):
+                    catalog.update_file(filename, f.identifier, f.format,
+                            f.ext, tags, tag_mtime)
+        if tags is not None:
             for key in tags:
                 if key in ('filename', 'basename', 'format', 'ext'):
                     # Don't override info taken from the file path on disk.
@@ -2320,8 +6124,7 @@ def _load_json(json_file):
 
     try:
         with open(json_file, 'r') as jsonfile:
-            j = json.load(jsonfile)
-        return jsons.load(j, strict=False)
+            return json.load(jsonfile)
 
     except:
         logger.error("Error loading json file: {}".format(json_file))
@@ -2346,10 +6149,23 @@ class BagValidationError(BagError):
 
     def __str__(self):
         if len(self.details) > 0:
-            details = "; ".join([force_unicode(e) for e in self.details])
+            details = "; ".join([str(e) for e in self.details])
             return "%s: %s" % (self.message, details)
         return self.message
 
+class DeriveTimeoutError(BagError):
+    """A derivation command was stopped after running out of time."""
+
+    def __init__(self, target, filename, timeout):
+        super(DeriveTimeoutError, self).__init__()
+        self.target = target
+        self.filename = filename
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Process timed out after %ds: %s for %s" % (
+                self.timeout, self.target, self.filename)
+
 
 if __name__ == "__main__":
     import doctest
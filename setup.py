@@ -21,7 +21,6 @@ setup(name='odea',
         ],
         },
       install_requires=[
-          'jsons',
           'dataclasses',
           'wsl-path-converter',
           'importlib_resources',
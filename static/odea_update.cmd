@@ -1,9 +1,12 @@
 :: This is a drop target for files to be processed by odea in a linux shell
+:: All the files (or directories) dropped are processed in a single run.
 
 @ECHO OFF
+set FILES=
 for %%i in (%*) do (
 
 @ECHO %%i
-wsl I=`wpc %%i`; odea --update --derive --filename "$I"
+call set FILES=%%FILES%% "$(wpc '%%~i')"
 )
+wsl odea --update --derive --filename %FILES%
 pause
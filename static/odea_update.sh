@@ -1,6 +1,4 @@
 #!/usr/bin/sh
-# This is a drop target for files to be processed by odea in a linux shell
-for i in "$@"; do
- echo $i
- odea --update --derive --filename "$i"
-done
+# This is a drop target for files to be processed by odea in a linux shell.
+# All the files (or directories) dropped are processed in a single run.
+odea --update --derive --filename "$@"